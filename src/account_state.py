@@ -0,0 +1,188 @@
+"""
+Ордера, исполнения и P&L аккаунтов из websocket топиков sor, str и spl.
+
+Состояние ведется инкрементально: IBKR присылает только изменившиеся поля,
+они сливаются с тем, что уже известно. Все изменения за один тик event loop
+собираются и уходят одной публикацией на канал:
+
+    {account}:ORDERS      — открытые ордера, hash order_id -> json
+    {account}:EXECUTIONS:{YYYYMMDD}
+                          — исполнения за день UTC, hash execution_id -> json,
+                            живет EXECUTIONS_KEEP_DAYS
+    {account}:PNL         — hash с последними значениями P&L
+
+В каналы {account}:ORDERS, {account}:EXECUTIONS и {account}:PNL
+публикуются дельты (список изменений).
+"""
+import asyncio
+import json
+from collections import defaultdict
+from datetime import datetime
+
+from termcolor import cprint
+
+from config import redis_key
+
+# статусы, после которых ордер больше не открыт
+TERMINAL_STATUSES = {"Filled", "Cancelled", "Inactive", "ApiCancelled"}
+
+# пауза перед повтором, если Redis не принял изменения
+FLUSH_RETRY_SECONDS = 3
+
+# сколько дней хранить hash исполнений в Redis
+EXECUTIONS_KEEP_DAYS = 7
+
+_account_state = None
+
+
+def dumps(data):
+    return json.dumps(data, indent=None, separators=(',', ':'), default=str)
+
+
+class AccountState:
+    def __init__(self, get_redis_func):
+        self.get_redis_func = get_redis_func
+        self.orders = defaultdict(dict)  # account -> {order_id: ордер}
+        self.executions = defaultdict(dict)  # account -> {execution_id: исполнение} за день
+        self.executions_day = None  # YYYYMMDD, UTC
+        self.pnl = {}  # account -> {поле: значение}
+
+        self._order_deltas = defaultdict(dict)  # account -> {order_id: изменения}
+        self._closed_orders = defaultdict(set)  # account -> {order_id}
+        self._execution_deltas = defaultdict(list)  # (account, день) -> [исполнение]
+        self._pnl_deltas = {}
+        self._flush_scheduled = False
+        self._flush_task = None  # asyncio держит задачи слабыми ссылками
+        self._redis_client = None
+
+    ###
+    # разбор топиков
+    ###
+    def update_orders(self, orders):
+        for update in orders:
+            order_id = update.get("orderId")
+            account = update.get("acct") or update.get("account")
+            if order_id is None or not account:
+                continue
+
+            order = self.orders[account].setdefault(order_id, {})
+            order.update(update)
+            self._order_deltas[account].setdefault(order_id, {}).update(update)
+
+            if order.get("status") in TERMINAL_STATUSES:
+                self.orders[account].pop(order_id, None)
+                self._closed_orders[account].add(order_id)
+
+        self._schedule_flush()
+
+    def update_executions(self, executions):
+        day = datetime.utcnow().strftime("%Y%m%d")
+        if day != self.executions_day:
+            # в памяти только исполнения текущего дня
+            self.executions_day = day
+            self.executions.clear()
+
+        for execution in executions:
+            execution_id = execution.get("execution_id")
+            account = execution.get("account") or execution.get("acct")
+            if not execution_id or not account:
+                continue
+
+            self.executions[account][execution_id] = execution
+            self._execution_deltas[account, day].append(execution)
+
+        self._schedule_flush()
+
+    def update_pnl(self, rows):
+        for row_key, row in rows.items():
+            # ключ вида "U1234567.Core"
+            account = row_key.split(".")[0]
+            self.pnl.setdefault(account, {}).update(row)
+            self._pnl_deltas.setdefault(account, {}).update(row)
+
+        self._schedule_flush()
+
+    ###
+    # публикация
+    ###
+    def _schedule_flush(self, delay=0):
+        if self._flush_scheduled:
+            return
+        self._flush_scheduled = True
+        # все, что придет до конца этого тика, уйдет одной пачкой
+        self._flush_task = asyncio.get_running_loop().create_task(self.flush(delay))
+
+    def _requeue(self, order_deltas, closed_orders, execution_deltas, pnl_deltas):
+        """
+        Вернуть несохраненные изменения в очередь, более новые поверх.
+        """
+        for account, deltas in order_deltas.items():
+            newer = self._order_deltas[account]
+            for order_id, delta in deltas.items():
+                newer[order_id] = dict(delta, **newer.get(order_id, {}))
+        for account, order_ids in closed_orders.items():
+            self._closed_orders[account] |= order_ids
+        for account, executions in execution_deltas.items():
+            self._execution_deltas[account][:0] = executions
+        for account, delta in pnl_deltas.items():
+            self._pnl_deltas[account] = dict(delta, **self._pnl_deltas.get(account, {}))
+
+    async def flush(self, delay=0):
+        if delay:
+            await asyncio.sleep(delay)
+        self._flush_scheduled = False
+
+        order_deltas, self._order_deltas = self._order_deltas, defaultdict(dict)
+        closed_orders, self._closed_orders = self._closed_orders, defaultdict(set)
+        execution_deltas, self._execution_deltas = self._execution_deltas, defaultdict(list)
+        pnl_deltas, self._pnl_deltas = self._pnl_deltas, {}
+
+        if self._redis_client is None:
+            self._redis_client = self.get_redis_func()
+
+        pipe = self._redis_client.pipeline(transaction=False)
+
+        for account, deltas in order_deltas.items():
+            channel = f"{account}:ORDERS"
+            key = redis_key(channel)
+            open_orders = {
+                order_id: dumps(self.orders[account][order_id])
+                for order_id in deltas if order_id in self.orders[account]
+            }
+            if open_orders:
+                pipe.hset(key, mapping=open_orders)
+            if closed_orders[account]:
+                pipe.hdel(key, *closed_orders[account])
+            pipe.publish(channel, dumps([
+                dict(delta, orderId=order_id) for order_id, delta in deltas.items()
+            ]))
+
+        for (account, day), executions in execution_deltas.items():
+            channel = f"{account}:EXECUTIONS"
+            key = redis_key(f"{channel}:{day}")
+            pipe.hset(key, mapping={e["execution_id"]: dumps(e) for e in executions})
+            pipe.expire(key, EXECUTIONS_KEEP_DAYS * 86400)
+            pipe.publish(channel, dumps(executions))
+
+        for account, delta in pnl_deltas.items():
+            channel = f"{account}:PNL"
+            pipe.hset(redis_key(channel), mapping={k: dumps(v) for k, v in self.pnl[account].items()})
+            pipe.publish(channel, dumps(delta))
+
+        try:
+            await pipe.execute()
+        except Exception as e:
+            cprint(f"account state flush error {e}", "red")
+            self._redis_client = None
+            # иначе hash в Redis разойдутся с памятью до следующих изменений
+            self._requeue(order_deltas, closed_orders, execution_deltas, pnl_deltas)
+            self._schedule_flush(FLUSH_RETRY_SECONDS)
+
+
+def get_account_state(get_redis_func):
+    global _account_state
+
+    if not _account_state:
+        _account_state = AccountState(get_redis_func)
+
+    return _account_state
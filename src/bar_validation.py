@@ -0,0 +1,123 @@
+"""
+Проверка пачки минутных баров IBKR перед записью.
+
+Пачка проверяется целиком массивами numpy, без цикла по строкам:
+
+    ohlc     l <= min(o, c) <= max(o, c) <= h, цены > 0
+    outlier  доходность close-to-close дальше OUTLIER_MADS робастных сигм
+             (MAD) от медианы предыдущих OUTLIER_WINDOW минут, окно
+             начинается с close баров, уже лежащих в базе до пачки
+    volume   объем отрицательный или нулевой, когда биржа открыта
+    jump     последний бар далеко от последней сделки из стрима
+
+Помеченные бары пишутся как обычно, но с полем "flags": ["ohlc", ...].
+"""
+import warnings
+
+FLAG_NAMES = ["ohlc", "outlier", "volume", "jump"]
+OHLC, OUTLIER, VOLUME, JUMP = (1 << i for i in range(len(FLAG_NAMES)))
+
+OUTLIER_WINDOW = 30
+OUTLIER_MIN_SAMPLES = 10  # с меньшим числом доходностей в окне не судим
+OUTLIER_MADS = 8
+MAD_SCALE = 1.4826  # MAD -> сигма для нормального распределения
+MIN_SIGMA = 0.0005  # на тихом рынке MAD бывает почти нулевой
+
+# со стримом сравниваем только бар не старше стольких секунд до сделки
+JUMP_MAX_AGE_SECONDS = 300
+
+
+def flag_names(mask):
+    return [name for i, name in enumerate(FLAG_NAMES) if mask & (1 << i)]
+
+
+def rolling_sigma(returns):
+    """
+    Медиана и робастная сигма предыдущих OUTLIER_WINDOW доходностей
+    для каждой минуты, NaN где замеров мало.
+    """
+    import numpy as np
+    from numpy.lib.stride_tricks import sliding_window_view
+
+    padded = np.concatenate([np.full(OUTLIER_WINDOW, np.nan), returns[:-1]])
+    windows = sliding_window_view(padded, OUTLIER_WINDOW)
+    enough = np.count_nonzero(~np.isnan(windows), axis=1) >= OUTLIER_MIN_SAMPLES
+
+    with warnings.catch_warnings():
+        # All-NaN slice в начале пачки
+        warnings.simplefilter("ignore", RuntimeWarning)
+        median = np.nanmedian(windows, axis=1)
+        mad = np.nanmedian(np.abs(windows - median[:, None]), axis=1)
+
+    sigma = np.maximum(mad * MAD_SCALE, MIN_SIGMA)
+    median[~enough] = np.nan
+    sigma[~enough] = np.nan
+    return median, sigma
+
+
+def validate_bars(bars, is_open=None, last_trade=None, history=None):
+    """
+    Маска флагов (бит на FLAG_NAMES) на каждый бар.
+
+    bars — бары IBKR o/h/l/c/v/t по возрастанию t,
+    is_open — открыта ли биржа в минуту каждого бара,
+    last_trade — (цена, ms) последней сделки из стрима или None,
+    history — close последних баров перед пачкой, по возрастанию времени:
+    ими заполняется окно выбросов, сами они не помечаются.
+    """
+    import numpy as np
+
+    n = len(bars)
+    flags = np.zeros(n, dtype=np.uint8)
+    if not n:
+        return flags
+
+    data = np.array(
+        [(b.get("o"), b.get("h"), b.get("l"), b.get("c"), b.get("v"), b["t"]) for b in bars],
+        dtype=float,
+    )
+    o, h, l, c, v, t = data.T
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        prices = data[:, :4]
+        bad_ohlc = ~np.isfinite(prices).all(axis=1) | (prices <= 0).any(axis=1)
+        bad_ohlc |= (l > np.minimum(o, c)) | (h < np.maximum(o, c))
+        flags[bad_ohlc] |= OHLC
+
+        bad_volume = ~np.isfinite(v) | (v < 0)
+        if is_open is not None:
+            bad_volume |= (v == 0) & np.asarray(is_open, dtype=bool)
+        flags[bad_volume] |= VOLUME
+
+        # битые бары в доходности не участвуют
+        past = np.asarray(history if history is not None else [], dtype=float)[-OUTLIER_WINDOW - 1:]
+        past = np.where(past > 0, past, np.nan)
+        log_c = np.concatenate([np.log(past), np.where(bad_ohlc, np.nan, np.log(c))])
+        returns = np.concatenate([[np.nan], np.diff(log_c)])
+        median, sigma = rolling_sigma(returns)
+        outlier = np.abs(returns - median) > OUTLIER_MADS * sigma
+
+        # одиночный выброс дает две доходности, туда и обратно:
+        # следующий бар не помечаем, если он вернулся к цене до выброса
+        after_outlier = np.concatenate([[False], outlier[:-1]])
+        skip = np.full(len(log_c), np.nan)
+        skip[2:] = log_c[2:] - log_c[:-2]
+        returned = np.abs(skip - median) <= OUTLIER_MADS * sigma * np.sqrt(2)
+        outlier &= ~(after_outlier & returned)
+
+        # дальше только бары пачки
+        log_c, median, sigma = log_c[-n:], median[-n:], sigma[-n:]
+        flags[outlier[-n:]] |= OUTLIER
+
+        if last_trade and last_trade[0] and not bad_ohlc[-1]:
+            price, trade_ms = last_trade
+            age = (trade_ms - t[-1] - 60_000) / 1000
+            # сделка может быть и внутри самой минуты бара
+            if -60 <= age <= JUMP_MAX_AGE_SECONDS:
+                # за age секунд цена может уйти дальше, чем за минуту
+                scale = sigma[-1] if np.isfinite(sigma[-1]) else MIN_SIGMA
+                scale *= np.sqrt(max(1.0, age / 60))
+                if abs(np.log(price) - log_c[-1]) > OUTLIER_MADS * scale:
+                    flags[-1] |= JUMP
+
+    return flags
@@ -0,0 +1,351 @@
+"""
+Минутные бары в Redis: сетка минут, разбор баров IBKR, слияние со старыми
+данными с флагами fix/late/empty и запись с публикацией в {symbol}:BARS.
+
+Общее для get_bars (HTTP history) и get_trades_async (websocket smh),
+поэтому без побочных эффектов при импорте.
+"""
+import json
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+import orjson
+from termcolor import cprint
+
+from bar_validation import FLAG_NAMES, OUTLIER_WINDOW, flag_names, validate_bars
+from calendars import get_schedule
+from config import get_redis_client, redis_key
+from profiling import stage
+from rollups import has_price, update_rollups
+from sequence import get_sequencer
+from snapshot import get_snapshot_key
+
+log = logging.getLogger("loader")
+
+# bars_source: websocket — живые бары приходят из get_trades_async (smh)
+BARS_WS_MAX_SUBSCRIPTIONS = 5  # столько smh подписок IBKR держит одновременно
+BARS_WS_SETTLE_SECONDS = 2  # бар минуты считается окончательным через столько секунд
+
+# Колонки дашборда, в порядке dash.csv
+DASH_STATUSES = ["ok", "closed", "error", "fix", "empty"]
+
+
+def get_line_status(j):
+    """
+    Статус минутной строки для дашборда.
+    """
+    if j.get("error"):
+        return "error"
+    elif j.get("closed"):
+        return "closed"
+    elif j.get("empty"):
+        return "empty"
+    elif j.get("fix") or j.get("late"):
+        return "fix"
+    return "ok"
+
+
+def dt_range(start, end, step=timedelta(minutes=1)):
+    curr = start
+    while curr <= end:
+        yield curr
+        curr += step
+
+
+def ts_to_dt(ts):
+    return datetime.utcfromtimestamp(ts / 1000)
+
+
+def dt_to_ts(dt):
+    return int(dt.replace(tzinfo=timezone.utc).timestamp())
+
+
+def get_key(instrument):
+    # Всё правильно, в базу бары складываются с ключом TRADES
+    return redis_key("{symbol}.{exchange}:TRADES".format(**instrument))
+
+
+def replace_data(instrument, line, ts, redis_client):
+    """
+    Запись в базу с заменой старых данных.
+    """
+    with stage("replace_data"):
+        key = get_key(instrument)
+        line_str = json.dumps(line, indent=None, separators=(',', ':'), default=str)
+        dt = ts_to_dt(ts*1000)
+        cprint(f"{key}, {ts}, {dt}, {line_str}", "white")
+        redis_client.zremrangebyscore(key, ts, ts)
+        redis_client.zadd(key, {line_str: ts})
+
+        symbol = "{symbol}.{exchange}".format(**instrument)
+        line["conid"] = instrument["conid"]
+        line["symbol"] = symbol
+        line_str = json.dumps(line, indent=None, separators=(',', ':'), default=str)
+        # с номером seq, пропуски подписчик дочитает из истории канала
+        get_sequencer(redis_client).publish(f"{symbol}:BARS", line_str)
+
+
+def get_exchange_schedule(exchange):
+    """
+    Расписание для биржи, см. calendars.get_schedule.
+    """
+    with stage("calendar"):
+        return get_schedule(exchange)
+
+
+@lru_cache(maxsize=2 ** 16)
+def check_open_time(exchange, cur_interval):
+    """
+    Открыта ли эта биржа в указанный момент.
+    """
+    schedule = get_exchange_schedule(exchange)
+    try:
+        return schedule.is_open(dt_to_ts(cur_interval))
+    except ValueError as e:
+        print(schedule.sessions[0], schedule.sessions[-1])
+        raise e
+
+
+def format_valid_interval(interval):
+    return {
+        "dt": datetime.strftime(interval["dt"], "%Y-%m-%d %H:%M:%S"),
+        "o": interval["o"],
+        "h": interval["h"],
+        "l": interval["l"],
+        "c": interval["c"],
+        "vol": interval["v"],
+        # "rth": int(interval["rth"]),
+    }
+
+
+def get_last_trade(instrument):
+    """
+    (цена, ms) последней сделки из снимка get_trades или None.
+    """
+    symbol = "{symbol}.{exchange}".format(**instrument)
+    try:
+        last, updated = get_redis_client().hmget(get_snapshot_key(symbol), "last", "updated")
+    except Exception as e:
+        log.debug(f"snapshot {symbol}: {e}")
+        return None
+    if not last or not updated:
+        return None
+    return float(last), float(updated)
+
+
+def get_history_closes(bars, data_grid):
+    """
+    close последних OUTLIER_WINDOW + 1 баров из базы (old) перед пачкой,
+    без помеченных выбросами и битыми.
+    """
+    first_ts = bars[0]["t"] // 1000
+    closes = []
+    for ts, line in data_grid.items():
+        if ts >= first_ts:
+            break
+        old = line.get("old")
+        if old and has_price(old) and not {"ohlc", "outlier"} & set(old.get("flags", ())):
+            closes.append(old["c"])
+    return closes[-OUTLIER_WINDOW - 1:]
+
+
+def check_bars(instrument, bars, data_grid):
+    """
+    Флаги подозрительных баров, см. bar_validation.
+    """
+    if not bars:
+        return []
+    with stage("validate"):
+        is_open = [data_grid.get(b["t"] // 1000, {}).get("is_it_open", False) for b in bars]
+        history = get_history_closes(bars, data_grid)
+        flags = validate_bars(bars, is_open, get_last_trade(instrument), history)
+    if flags.any():
+        cprint(f"{instrument['symbol']}: suspicious bars {int((flags != 0).sum())}", "yellow")
+    return flags
+
+
+def apply_bars(instrument, bars, data_grid):
+    """
+    Разложить бары IBKR (o/h/l/c/v/t, по возрастанию t) по сетке в new.
+    Пропуски внутри открытой биржи заполняются EMPTY,
+    подозрительные бары получают flags.
+    Одинаково для HTTP history и websocket smh.
+    """
+    flags = check_bars(instrument, bars, data_grid)
+    mnt = timedelta(minutes=1)
+    prev_dt = None
+    for interval, mask in zip(bars, flags):
+        ts = interval["t"] // 1000
+
+        dt = ts_to_dt(interval["t"])
+
+        # Если перед этим интервалом был гэп — навставлять EMPTY
+        if dt and prev_dt and dt - prev_dt > mnt:
+            cprint("large gap", "blue")
+            for gap_dt in dt_range(prev_dt + mnt, dt - mnt):
+                if check_open_time(instrument["exchange"], gap_dt):
+                    gap_ts = dt_to_ts(gap_dt)
+                    if gap_ts in data_grid:
+                        interval["dt"] = gap_dt
+                        data_grid[gap_ts]["new"] = {
+                            "dt": datetime.strftime(gap_dt, "%Y-%m-%d %H:%M:%S"),
+                            "empty": 1,
+                        }
+                        data_grid[gap_ts]["t"] = gap_ts * 1000
+
+        if ts in data_grid:
+            interval["dt"] = dt
+            data_grid[ts]["new"] = format_valid_interval(interval)
+            if mask:
+                data_grid[ts]["new"]["flags"] = flag_names(mask)
+            data_grid[ts]["t"] = interval["t"]
+        else:
+            log.debug(f"Time is not in data_grid {ts} {dt}")
+        prev_dt = dt
+
+
+def build_grid(symbol, start, interval_dt):
+    """
+    Пустая сетка минутных интервалов [start, interval_dt] с расписанием биржи.
+    """
+    with stage("grid"):
+        data_grid = {}
+        for cur_interval in dt_range(start, interval_dt):
+            is_it_open = check_open_time(symbol["exchange"], cur_interval)
+            data_grid[dt_to_ts(cur_interval)] = {
+                "dt": datetime.strftime(cur_interval, "%Y-%m-%d %H:%M:%S"),
+                "is_it_open": is_it_open,
+            }
+    return data_grid
+
+
+def load_old_lines(symbol, data_grid, start, redis_client):
+    """
+    Положить интервалы из базы в сетку как old.
+    False, если в базе битый json.
+    """
+    key = get_key(symbol)
+    with stage("redis_read"):
+        data_in_db = redis_client.zrangebyscore(key, dt_to_ts(start), 10 ** 10)
+
+    with stage("json_parse"):
+        for line in data_in_db:
+            line = line.decode()
+            try:
+                line_data = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                log.error(f"JSONDecodeError: {line}")
+                return False
+            dt = datetime.strptime(line_data["dt"], "%Y-%m-%d %H:%M:%S")
+            ts = dt_to_ts(dt)
+            if ts in data_grid:
+                data_grid[ts]["old"] = line_data
+
+    return True
+
+
+def keep_jump(line):
+    """
+    jump проверяется только у последнего бара пачки и только пока сделка
+    свежая: при следующей загрузке тех же цен он не должен пропадать.
+    """
+    old_line, new_line = line.get("old", {}), line.get("new")
+    if not new_line or "jump" not in old_line.get("flags", ()):
+        return
+    new_flags = new_line.get("flags", [])
+    if "jump" in new_flags:
+        return
+    data = {k: v for k, v in new_line.items() if k != "flags"}
+    if data == {k: v for k, v in old_line.items() if k != "flags"}:
+        new_line["flags"] = [name for name in FLAG_NAMES if name in new_flags or name == "jump"]
+
+
+def save_grid(symbol, data_grid, interval_dt, redis_client):
+    """
+    Сохранить new, которые отличаются от old: исправления с флагом fix,
+    новые данные за прошлые минуты (раньше interval_dt) с флагом late.
+    """
+    # Минуты с ценами, которые поменялись — для старших таймфреймов
+    price_minutes = []
+
+    # Найти различачающиеся данные и сохранить или вывести ошибку
+    for score, line in data_grid.items():
+
+        # Уже были данные
+        if "old" in line:
+            # Но теперь есть другие данные
+            old_line = line["old"]
+            old_line.pop('late', None)
+            old_line.pop('fix', None)
+            old_line.pop('avg', None)
+            old_line.pop('cnt', None)
+            old_line.pop('rth', None)
+            keep_jump(line)
+            # флаги сравниваются вместе с данными: новые флаги на тех же
+            # ценах тоже сохраняются
+            if "new" in line and line["new"] != old_line:
+                new_line = line["new"]
+                new_line["fix"] = 1
+                replace_data(symbol, new_line, score, redis_client)
+                if has_price(new_line) or has_price(old_line):
+                    price_minutes.append(score)
+
+        # Данных не было
+        else:
+            if new_line := line.get("new"):
+                # Если данные пришли не real-time, то ставлю флаг LATE
+                if datetime.strptime(line["dt"], "%Y-%m-%d %H:%M:%S") < interval_dt:
+                    new_line["late"] = 1
+                replace_data(symbol, new_line, score, redis_client)
+                if has_price(new_line):
+                    price_minutes.append(score)
+            else:
+                log.debug("Данных всё нет и нет")
+
+    if price_minutes:
+        with stage("rollups"):
+            update_rollups(symbol, price_minutes, redis_client)
+
+
+def settle_delay(bar):
+    """
+    Через сколько секунд бар станет окончательным, <= 0 — уже.
+    IBKR шлет последнее обновление минуты в момент ее закрытия или чуть позже.
+    """
+    return (bar["t"] + 60_000) / 1000 + BARS_WS_SETTLE_SECONDS - time.time()
+
+
+def merge_bars(symbol, bars, redis_client):
+    """
+    Слить бары, пришедшие по websocket (smh), с тем, что лежит в Redis,
+    по тем же правилам, что update_instrument. Незаконченные минуты
+    пропускаются, закрытые биржи и ошибки остаются на get_bars.
+    """
+    cur_minute = datetime.utcnow().replace(second=0, microsecond=0)
+    bars = sorted((b for b in bars if settle_delay(b) <= 0), key=lambda b: b["t"])
+    if not bars:
+        return
+
+    start = ts_to_dt(bars[0]["t"])
+    interval_dt = cur_minute - timedelta(minutes=1)
+    # минуты перед пачкой — только старые close для окна выбросов
+    history_start = start - timedelta(minutes=OUTLIER_WINDOW + 1)
+    data_grid = build_grid(symbol, history_start, interval_dt)
+    if not load_old_lines(symbol, data_grid, history_start, redis_client):
+        return
+
+    apply_bars(symbol, bars, data_grid)
+    save_grid(symbol, data_grid, interval_dt, redis_client)
+
+
+def get_ws_bar_instruments(config):
+    """
+    Инструменты, чьи живые бары приходят по websocket (bars_source: websocket).
+    IBKR держит ограниченное число подписок smh, остальные грузятся по HTTP.
+    """
+    if config.get('bars_source', 'http') != 'websocket':
+        return []
+    limit = config.get('bars_ws_max_subscriptions', BARS_WS_MAX_SUBSCRIPTIONS)
+    return config['instruments'][:limit]
@@ -0,0 +1,542 @@
+"""
+Бенчмарк демонов без живого аккаунта IBKR.
+
+Поднимает фейковый IBKR web API (/iserver/marketdata/history и websocket
+с топиками smd, sts, hb и tic) и гоняет через него get_bars.update_instrument,
+loader, update_dash и IbkrWebsocketClient. Redis — in-process фейк или
+локальный, если передан --redis-url.
+
+    python benchmark.py --sizes 5,100,1000 --output bench.json
+    python benchmark.py --compare bench.json
+"""
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime, timedelta
+from functools import partial
+from types import SimpleNamespace
+from urllib.parse import urlparse, parse_qs
+
+import click
+import websockets
+
+import bars
+import config
+import get_bars
+import get_trades_async
+
+BENCH_EXCHANGES = ["NASDAQ", "NYSE", "ARCA", "GLOBEX"]
+
+logging.getLogger("websockets").setLevel(logging.WARNING)
+
+
+###
+# In-process Redis
+###
+class FakeRedis:
+    """
+    Минимальный Redis в памяти: только то, чем пользуются демоны.
+    """
+    def __init__(self):
+        self.zsets = defaultdict(dict)  # key -> {member: score}
+        self.values = {}  # key -> строка
+        self.subscribers = []  # callback(channel, message)
+
+    @staticmethod
+    def _encode(value):
+        return value if isinstance(value, bytes) else str(value).encode()
+
+    def zadd(self, key, mapping):
+        zset = self.zsets[key]
+        for member, score in mapping.items():
+            zset[self._encode(member)] = score
+        return len(mapping)
+
+    def zrangebyscore(self, key, min_score, max_score, withscores=False):
+        zset = self.zsets.get(key, {})
+        items = [(s, m) for m, s in zset.items() if min_score <= s <= max_score]
+        items.sort()
+        if withscores:
+            return [(m, float(s)) for s, m in items]
+        return [m for s, m in items]
+
+    def zcount(self, key, min_score, max_score):
+        return len(self.zrangebyscore(key, min_score, max_score))
+
+    def zremrangebyscore(self, key, min_score, max_score):
+        zset = self.zsets.get(key, {})
+        members = [m for m, s in zset.items() if min_score <= s <= max_score]
+        for member in members:
+            del zset[member]
+        return len(members)
+
+    def set(self, key, value):
+        self.values[key] = self._encode(value)
+        return True
+
+    def hmget(self, key, *fields):
+        # снимков get_trades в бенчмарке нет
+        return [None] * len(fields)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.zsets.pop(key, None)
+            self.values.pop(key, None)
+
+    def publish(self, channel, message):
+        for callback in self.subscribers:
+            callback(channel, message)
+        return len(self.subscribers)
+
+    def pipeline(self, transaction=False):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis_client):
+        self._redis = redis_client
+        self._calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self._redis, name)
+
+        def call(*args, **kwargs):
+            self._calls.append((method, args, kwargs))
+            return self
+
+        return call
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        return [method(*args, **kwargs) for method, args, kwargs in calls]
+
+
+class AsyncFakeRedis:
+    """
+    Асинхронная обертка над тем же хранилищем, как aioredis клиент.
+    """
+    def __init__(self, redis_client):
+        self._redis = redis_client
+
+    async def publish(self, channel, message):
+        return self._redis.publish(channel, message)
+
+    async def set(self, key, value):
+        return self._redis.set(key, value)
+
+    async def close(self):
+        pass
+
+
+###
+# Фейковый IBKR
+###
+def fake_bar(conid, minute_ts):
+    base = 100 + conid % 50 + (minute_ts // 60) % 17 * 0.01
+    return {
+        "o": round(base, 2),
+        "c": round(base + 0.01, 2),
+        "h": round(base + 0.02, 2),
+        "l": round(base - 0.01, 2),
+        "v": 100 + minute_ts // 60 % 7,
+        "t": minute_ts * 1000,
+    }
+
+
+class FakeIb:
+    """
+    Заменяет IbApi: history по "HTTP" и адрес фейкового websocket.
+    """
+    def __init__(self, instruments, ws_url=None, http_latency=0.0):
+        self.instruments_by_conid = {i["conid"]: i for i in instruments}
+        self.ws_url = ws_url
+        self.http_latency = http_latency
+        self.session = SimpleNamespace(cookies={"cp": "bench"})
+        self.requests = 0
+
+    def reset_session(self):
+        pass
+
+    def load_session(self):
+        pass
+
+    def get_portal_url(self):
+        return "https://localhost:5000/v1/api"
+
+    def get_websocket_url(self):
+        return self.ws_url
+
+    def iserver_request(self, url, method):
+        self.requests += 1
+        if self.http_latency:
+            time.sleep(self.http_latency)
+
+        query = parse_qs(urlparse(url).query)
+        conid = int(query["conid"][0])
+        period = int(query["period"][0].replace("min", ""))
+        exchange = self.instruments_by_conid[conid]["exchange"]
+
+        last_minute = datetime.utcnow().replace(second=0, microsecond=0)
+        last_minute -= timedelta(minutes=1)
+        data = []
+        for dt in bars.dt_range(last_minute - timedelta(minutes=period - 1), last_minute):
+            if bars.check_open_time(exchange, dt):
+                data.append(fake_bar(conid, bars.dt_to_ts(dt)))
+
+        return {"data": data}
+
+
+class FakeIbkrWebsocket:
+    """
+    Websocket IBKR: авторизация через sts, hb раз в секунду,
+    ответы на tic и поток smd с заданной частотой на инструмент.
+    """
+    def __init__(self, tick_rate):
+        self.tick_rate = tick_rate
+        self.sent = {}  # seq -> perf_counter() отправки
+        self._seq = 0
+        self._server = None
+
+    async def start(self):
+        self._server = await websockets.serve(self.handler, "127.0.0.1", 0)
+        port = self._server.sockets[0].getsockname()[1]
+        return f"ws://127.0.0.1:{port}/v1/api/ws"
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def handler(self, ws, path=None):
+        subscribed = set()
+        await ws.send(json.dumps({"message": "waiting for session"}))
+        stream = asyncio.create_task(self.stream(ws, subscribed))
+        try:
+            async for msg in ws:
+                if msg.startswith("{") and "session" in msg:
+                    await ws.send(json.dumps({
+                        "topic": "sts", "args": {"authenticated": True},
+                    }))
+                elif msg.startswith("smd+"):
+                    subscribed.add(int(msg.split("+")[1]))
+                elif msg.startswith("umd+"):
+                    subscribed.discard(int(msg.split("+")[1]))
+                elif msg == "tic":
+                    await ws.send(json.dumps({"topic": "tic", "alive": True}))
+                elif msg == "ech+hb":
+                    await ws.send("ech+hb")
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            stream.cancel()
+
+    async def stream(self, ws, subscribed):
+        step = 0.01
+        last_hb = 0
+        due = 0.0
+        while True:
+            await asyncio.sleep(step)
+            now = time.time()
+            if now - last_hb >= 1:
+                await ws.send(json.dumps({"topic": "hb", "hb": int(now * 1000)}))
+                last_hb = now
+
+            due += len(subscribed) * self.tick_rate * step
+            conids = list(subscribed)
+            while due >= 1 and conids:
+                due -= 1
+                self._seq += 1
+                conid = conids[self._seq % len(conids)]
+                self.sent[self._seq] = time.perf_counter()
+                await ws.send(json.dumps({
+                    "topic": f"smd+{conid}",
+                    "conid": conid,
+                    "_updated": int(time.time() * 1000),
+                    "31": str(self._seq),
+                }))
+
+
+###
+# Измерения
+###
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))
+    return values[idx]
+
+
+def latency_stats(prefix, latencies, count, duration):
+    return {
+        f"{prefix}.per_sec": round(count / duration, 1) if duration else 0.0,
+        f"{prefix}.p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        f"{prefix}.p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Демоны много печатают, на бенчмарк это влиять не должно.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+@contextlib.contextmanager
+def traced(result, key):
+    tracemalloc.start()
+    try:
+        yield
+    finally:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result[key] = round(peak / 1024, 1)
+
+
+def make_instruments(size):
+    return [
+        {
+            "conid": 100000 + n,
+            "symbol": f"BENCH{n}",
+            "exchange": BENCH_EXCHANGES[n % len(BENCH_EXCHANGES)],
+        }
+        for n in range(size)
+    ]
+
+
+def prepare_bars(instruments, redis_client, interval_dt):
+    """
+    Заполнить базу так, как будто loader уже отработал,
+    и убрать последний интервал — его и будем грузить.
+    """
+    start = interval_dt.replace(second=0, microsecond=0) - timedelta(days=3, minutes=1)
+    for instrument in instruments:
+        key = bars.get_key(instrument)
+        redis_client.delete(key)
+        mapping = {}
+        for dt in bars.dt_range(start, interval_dt - timedelta(minutes=1)):
+            ts = bars.dt_to_ts(dt)
+            if bars.check_open_time(instrument["exchange"], dt):
+                bar = fake_bar(instrument["conid"], ts)
+                bar["dt"] = dt
+                line = bars.format_valid_interval(bar)
+            else:
+                line = {"dt": datetime.strftime(dt, "%Y-%m-%d %H:%M:%S"), "closed": 1}
+            mapping[json.dumps(line, separators=(',', ':'))] = ts
+        redis_client.zadd(key, mapping)
+
+
+def drop_interval(instruments, redis_client, interval_dt):
+    ts = bars.dt_to_ts(interval_dt)
+    for instrument in instruments:
+        redis_client.zremrangebyscore(bars.get_key(instrument), ts, ts)
+
+
+def bench_bars(instruments, redis_client, http_latency):
+    result = {}
+    size = len(instruments)
+    ib = FakeIb(instruments, http_latency=http_latency)
+    dt_start = datetime.utcnow()
+    interval_dt = dt_start.replace(second=0, microsecond=0) - timedelta(minutes=1)
+
+    with quiet():
+        prepare_bars(instruments, redis_client, interval_dt)
+
+        # update_instrument по одному
+        latencies = []
+        started = time.perf_counter()
+        for instrument in instruments:
+            t = time.perf_counter()
+            get_bars.update_instrument(ib, interval_dt, instrument, redis_client)
+            latencies.append(time.perf_counter() - t)
+        duration = time.perf_counter() - started
+        result.update(latency_stats(f"bars.{size}.update_instrument", latencies, size, duration))
+
+        drop_interval(instruments, redis_client, interval_dt)
+        with traced(result, f"bars.{size}.update_instrument.alloc_kib"):
+            for instrument in instruments:
+                get_bars.update_instrument(ib, interval_dt, instrument, redis_client)
+
+        # loader целиком
+        drop_interval(instruments, redis_client, interval_dt)
+        started = time.perf_counter()
+        asyncio.run(get_bars.loader(lambda: ib, dt_start, instruments, redis_client))
+        result[f"bars.{size}.loader_ms"] = round((time.perf_counter() - started) * 1000, 3)
+
+        # update_dash
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_path = os.path.join(tmp, "dash.csv")
+            started = time.perf_counter()
+            get_bars.update_dash(instruments, csv_path, redis_client)
+            result[f"bars.{size}.update_dash_ms"] = round((time.perf_counter() - started) * 1000, 3)
+            with traced(result, f"bars.{size}.update_dash.alloc_kib"):
+                get_bars.update_dash(instruments, csv_path, redis_client)
+
+    result[f"bars.{size}.ibkr_requests"] = ib.requests
+    return result
+
+
+async def run_trades(instruments, redis_client, new_async_redis, tick_rate, duration):
+    # соединения aioredis привязаны к event loop, клиент — на каждый прогон
+    async_redis = new_async_redis()
+    server = FakeIbkrWebsocket(tick_rate)
+    ib = FakeIb(instruments, ws_url=await server.start())
+    cfg = config.get_config()
+    cfg["instruments"][:] = instruments
+
+    latencies = []
+
+    def on_publish(channel, message):
+        if not channel.endswith(":TRADES"):
+            return
+        seq = int(json.loads(message)["price"])
+        if seq in server.sent:
+            latencies.append(time.perf_counter() - server.sent.pop(seq))
+
+    subscriber = None
+    if isinstance(redis_client, FakeRedis):
+        redis_client.subscribers.append(on_publish)
+    else:
+        subscriber = asyncio.create_task(subscribe_real(async_redis, on_publish))
+
+    ws = await get_trades_async.get_ws_client(ib, cfg)
+    ws.get_redis_func = lambda: async_redis
+    ws.init_redis()
+
+    listener = asyncio.create_task(ws.listen_messages())
+    await asyncio.sleep(duration)
+    listener.cancel()
+    if subscriber:
+        subscriber.cancel()
+    await ws.close()
+    await server.stop()
+    await async_redis.close()
+
+    if isinstance(redis_client, FakeRedis):
+        redis_client.subscribers.remove(on_publish)
+
+    return latencies
+
+
+async def subscribe_real(async_redis, callback):
+    pubsub = async_redis.pubsub()
+    await pubsub.psubscribe("BENCH*:TRADES")
+    async for msg in pubsub.listen():
+        if msg["type"] == "pmessage":
+            callback(msg["channel"], msg["data"])
+
+
+def bench_trades(instruments, redis_client, new_async_redis, tick_rate, duration):
+    result = {}
+    size = len(instruments)
+
+    with quiet():
+        latencies = asyncio.run(
+            run_trades(instruments, redis_client, new_async_redis, tick_rate, duration)
+        )
+    result.update(latency_stats(f"trades.{size}", latencies, len(latencies), duration))
+
+    with quiet(), traced(result, f"trades.{size}.alloc_kib"):
+        asyncio.run(
+            run_trades(instruments, redis_client, new_async_redis, tick_rate, min(duration, 2))
+        )
+
+    return result
+
+
+def compare(result, baseline, tolerance):
+    """
+    Что стало хуже базового прогона больше чем на tolerance.
+    """
+    regressions = []
+    for key, base in baseline.items():
+        value = result.get(key)
+        if value is None or not base:
+            continue
+        if key.endswith("per_sec"):
+            worse = value < base * (1 - tolerance)
+        elif key.endswith("_ms") or key.endswith("_kib"):
+            worse = value > base * (1 + tolerance)
+        else:
+            continue
+        if worse:
+            regressions.append((key, base, value))
+    return regressions
+
+
+def write_bench_config(path):
+    with open(path, "w") as f:
+        f.write(
+            "redis:\n"
+            "  host: 127.0.0.1\n"
+            "  port: 6379\n"
+            "  db: 0\n"
+            "  password: null\n"
+            "instruments: []\n"
+            # меряем свой код, а не паузы лимитера
+            "rate_limit: false\n"
+        )
+
+
+@click.command()
+@click.option('--sizes', default="5,100,1000", help="Количество инструментов")
+@click.option('--tick-rate', default=1.0, help="Тиков в секунду на инструмент")
+@click.option('--duration', default=5.0, help="Секунд на прогон websocket")
+@click.option('--http-latency', default=0.0, help="Задержка фейкового HTTP, секунд")
+@click.option('--redis-url', default=None, help="Локальный Redis вместо фейка")
+@click.option('--only', type=click.Choice(["bars", "trades"]), default=None)
+@click.option('--output', type=click.Path(), default=None, help="Сохранить результат в JSON")
+@click.option('--compare', 'baseline_path', type=click.Path(exists=True), default=None,
+              help="Сравнить с сохраненным результатом")
+@click.option('--tolerance', default=0.2, help="Допустимое ухудшение")
+def main(sizes, tick_rate, duration, http_latency, redis_url, only,
+         output, baseline_path, tolerance):
+    with tempfile.TemporaryDirectory() as tmp:
+        config_path = os.path.join(tmp, "bench.yaml")
+        write_bench_config(config_path)
+        config.get_config(config_path)
+
+        if redis_url:
+            import aioredis
+            import redis
+            redis_client = redis.Redis.from_url(redis_url)
+            new_async_redis = partial(aioredis.from_url, redis_url)
+        else:
+            redis_client = FakeRedis()
+            new_async_redis = partial(AsyncFakeRedis, redis_client)
+
+        result = {}
+        for size in [int(s) for s in sizes.split(",")]:
+            instruments = make_instruments(size)
+            if only in (None, "bars"):
+                result.update(bench_bars(instruments, redis_client, http_latency))
+            if only in (None, "trades"):
+                result.update(bench_trades(instruments, redis_client, new_async_redis,
+                                           tick_rate, duration))
+
+    for key, value in result.items():
+        print(f"{key:50} {value}")
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            regressions = compare(result, json.load(f), tolerance)
+        for key, base, value in regressions:
+            print(f"REGRESSION {key}: {base} -> {value}")
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Расписания бирж в виде отсортированных сессий [open, close) в unix-секундах.
+
+pandas_market_calendars тяжелый (тянет pandas) и считает расписание долго,
+поэтому он импортируется только при пересчете, а результат сохраняется
+на диск и переживает рестарты демонов.
+"""
+import json
+import os
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
+from os.path import join
+
+from termcolor import cprint
+
+EXCHANGE_SCHEDULE = {
+    "NASDAQ": "NASDAQ",
+    "NYMEX": "NYSE",
+    "NYSE": "NYSE",
+    "ARCA": "NYSE",
+    "GLOBEX": "CME_Rate",
+}
+
+# сколько дней расписания считать назад и вперед
+DAYS_BACK = 10
+DAYS_FORWARD = 100
+
+# пересчитать, если расписания вперед осталось меньше
+MIN_DAYS_FORWARD = 30
+
+_schedules = {}
+_cache_dir = None
+
+
+class ExchangeSchedule:
+    def __init__(self, name, sessions):
+        self.name = name
+        self.sessions = sessions
+        self._opens = [s[0] for s in sessions]
+
+    @property
+    def start(self):
+        return self.sessions[0][0]
+
+    @property
+    def end(self):
+        return self.sessions[-1][1]
+
+    def _session_index(self, ts):
+        if ts < self.start or ts > self.end:
+            raise ValueError(f"{self.name}: {ts} is not covered by the schedule")
+        return bisect_right(self._opens, ts) - 1
+
+    def is_open(self, ts):
+        i = self._session_index(ts)
+        return i >= 0 and ts < self.sessions[i][1]
+
+    def last_close(self, ts):
+        """
+        Конец последней сессии, начавшейся не позже ts, или None.
+        """
+        i = bisect_right(self._opens, ts) - 1
+        if i >= 0:
+            return self.sessions[i][1]
+        return None
+
+    def next_open(self, ts):
+        """
+        Начало ближайшей сессии после ts или None, если расписание кончилось.
+        """
+        i = bisect_right(self._opens, ts)
+        if i < len(self.sessions):
+            return self.sessions[i][0]
+        return None
+
+    def to_json(self):
+        return {"name": self.name, "sessions": self.sessions}
+
+
+def set_cache_dir(path):
+    global _cache_dir
+    _cache_dir = path
+    if path:
+        os.makedirs(path, exist_ok=True)
+
+
+def compute_schedule(name):
+    """
+    Посчитать расписание через pandas_market_calendars.
+    """
+    import pandas_market_calendars as mcal
+
+    calendar = mcal.get_calendar(name)
+
+    # нужно покрыть вперед и назад все возможные выходные
+    start = datetime.utcnow() - timedelta(days=DAYS_BACK)
+    end = datetime.utcnow() + timedelta(days=DAYS_FORWARD)
+
+    # TODO: убрать хардкодинг
+    if name in ["NYSE", "NASDAQ"]:
+        schedule = calendar.schedule(start, end, start="pre", end="post")
+    else:
+        schedule = calendar.schedule(start, end)
+
+    # как в calendar.open_at_time: от самой ранней до самой поздней колонки
+    market_times = list(schedule.columns)
+    lowest, highest = market_times[0], market_times[-1]
+
+    sessions = []
+    for _, day in schedule.iterrows():
+        opened, closed = int(day[lowest].timestamp()), int(day[highest].timestamp())
+        if "break_start" in schedule.columns:
+            sessions.append([opened, int(day["break_start"].timestamp())])
+            sessions.append([int(day["break_end"].timestamp()), closed])
+        else:
+            sessions.append([opened, closed])
+
+    return ExchangeSchedule(name, sessions)
+
+
+def _cache_path(name):
+    return join(_cache_dir, f"{name}.json")
+
+
+def load_cached_schedule(name):
+    if not _cache_dir:
+        return None
+    try:
+        with open(_cache_path(name)) as f:
+            data = json.load(f)
+        return ExchangeSchedule(data["name"], data["sessions"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_cached_schedule(schedule):
+    if not _cache_dir:
+        return
+    path = _cache_path(schedule.name)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(schedule.to_json(), f)
+    os.replace(tmp_path, path)
+
+
+def is_fresh(schedule):
+    now = datetime.utcnow().replace(tzinfo=timezone.utc).timestamp()
+    return (schedule.start <= now - 3 * 24 * 3600
+            and schedule.end >= now + MIN_DAYS_FORWARD * 24 * 3600)
+
+
+def get_schedule(exchange):
+    """
+    Расписание биржи: из памяти, с диска или пересчитать.
+    """
+    name = EXCHANGE_SCHEDULE[exchange]
+
+    schedule = _schedules.get(name)
+    if schedule and is_fresh(schedule):
+        return schedule
+
+    schedule = load_cached_schedule(name)
+    if not schedule or not is_fresh(schedule):
+        cprint(f"Пересчет расписания {name}", "blue")
+        schedule = compute_schedule(name)
+        save_cached_schedule(schedule)
+
+    _schedules[name] = schedule
+    return schedule
+
+
+def warm_up(exchanges):
+    """
+    Загрузить расписания заранее, чтобы не тратить на это первую минуту.
+    """
+    for exchange in set(exchanges):
+        get_schedule(exchange)
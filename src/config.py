@@ -1,62 +1,307 @@
-from os.path import abspath
-
-import redis
-import yaml
-from ibkr_web_api import IbApi
-from ibkr_web_api.session_storage import RedisStorage
+"""
+Тяжелые зависимости (yaml, redis, ibkr_web_api) импортируются
+внутри функций, чтобы не замедлять старт демонов.
+"""
+from os.path import abspath, getmtime
 
 _config = None
+_config_path = None
+_config_mtime = None
 _redis_client = None
+_async_redis_pool = None
 _ib_instance = None
+_rate_limiter = None
+
+# Дополняют config['redis']
+REDIS_DEFAULTS = {
+    "mode": "standalone",  # standalone, sentinel или cluster
+    "max_connections": 32,  # на процесс; больше, чем потоков и задач, пишущих в Redis
+    "pool_timeout": 5,  # секунд ждать свободное соединение из пула
+    "socket_timeout": 5,
+    "health_check_interval": 30,  # PING перед командой, если соединение простаивало
+    "retries": 3,  # повторы команды после обрыва соединения
+    "key_prefix": "",
+}
 
 
 def get_config(config_path=None):
-    global _config
+    global _config, _config_path, _config_mtime
 
     if not _config:
         if config_path is None:
             raise Exception('config not defined')
 
-        config_path = abspath(config_path)
-        _config = yaml.full_load(open(config_path))
+        import yaml
+
+        _config_path = abspath(config_path)
+        _config_mtime = getmtime(_config_path)
+        _config = yaml.full_load(open(_config_path))
 
     return _config
 
 
+def reload_instruments():
+    """
+    Перечитать список инструментов, если конфиг изменился на диске.
+
+    Список в config['instruments'] обновляется на месте, чтобы все,
+    кто держит на него ссылку, сразу видели новый состав.
+    Возвращает (добавленные, удаленные) инструменты.
+    """
+    global _config_mtime
+
+    config = get_config()
+
+    try:
+        mtime = getmtime(_config_path)
+    except OSError:
+        # файл могут прямо сейчас перезаписывать
+        return [], []
+
+    if mtime == _config_mtime:
+        return [], []
+
+    import yaml
+
+    try:
+        new_config = yaml.full_load(open(_config_path))
+        new_instruments = new_config['instruments']
+    except Exception:
+        # недописанный или битый yaml, попробуем в следующий раз
+        return [], []
+
+    _config_mtime = mtime
+
+    old_instruments = config['instruments']
+    added = [i for i in new_instruments if i not in old_instruments]
+    removed = [i for i in old_instruments if i not in new_instruments]
+    old_instruments[:] = new_instruments
+
+    return added, removed
+
+
+def get_redis_settings(config=None):
+    if config is None:
+        config = get_config()
+    return {**REDIS_DEFAULTS, **config['redis']}
+
+
+def redis_key(key):
+    """
+    Имя ключа с key_prefix из config['redis'], чтобы несколько установок
+    могли жить в одном Redis. Каналы pub/sub не префиксуются, ключи сессий
+    (RedisStorage в new_ib_instance) тоже: сессия одна на username.
+    """
+    return get_config()['redis'].get('key_prefix', '') + key
+
+
+def new_redis_client(config=None):
+    """
+    Синхронный клиент с пулом соединений: один Redis, Sentinel или Cluster.
+    """
+    import redis
+    from redis.backoff import ExponentialBackoff
+    from redis.retry import Retry
+
+    settings = get_redis_settings(config)
+    connection_kwargs = dict(
+        password=settings["password"],
+        socket_timeout=settings["socket_timeout"],
+        socket_keepalive=True,
+        health_check_interval=settings["health_check_interval"],
+        retry_on_timeout=True,
+        retry=Retry(ExponentialBackoff(cap=1, base=0.05), settings["retries"]),
+    )
+
+    if settings["mode"] == "cluster":
+        from redis.cluster import ClusterNode, RedisCluster
+
+        nodes = settings.get("startup_nodes") or [[settings["host"], settings["port"]]]
+        return RedisCluster(
+            startup_nodes=[ClusterNode(host, port) for host, port in nodes],
+            max_connections=settings["max_connections"],
+            **connection_kwargs,
+        )
+
+    if settings["mode"] == "sentinel":
+        from redis.sentinel import Sentinel
+
+        sentinel = Sentinel(
+            [tuple(s) for s in settings["sentinels"]],
+            sentinel_kwargs={
+                "password": settings.get("sentinel_password"),
+                "socket_timeout": settings["socket_timeout"],
+            },
+        )
+        return sentinel.master_for(
+            settings["service_name"],
+            db=settings["db"],
+            max_connections=settings["max_connections"],
+            **connection_kwargs,
+        )
+
+    pool = redis.BlockingConnectionPool(
+        host=settings["host"],
+        port=settings["port"],
+        db=settings["db"],
+        max_connections=settings["max_connections"],
+        timeout=settings["pool_timeout"],
+        **connection_kwargs,
+    )
+    return redis.Redis(connection_pool=pool)
+
+
 def get_redis_client(config=None):
     """
-    Функция на случай, если захотим заменить это connection pool
+    Общий на процесс синхронный клиент, потокобезопасный за счет пула.
     """
     global _redis_client
 
     if not _redis_client:
-        if config is None:
-            config = get_config()
+        _redis_client = new_redis_client(config)
+
+    return _redis_client
+
 
-        _redis_client = redis.Redis(
-            config['redis']["host"],
-            config['redis']["port"],
-            config['redis']["db"],
-            config['redis']["password"],
+def get_async_redis_client(config=None):
+    """
+    aioredis клиент поверх общего на процесс пула.
+
+    Клиенты дешевые, их можно пересоздавать после ошибок:
+    битые соединения пул выбрасывает сам. Cluster в aioredis 2.0 нет.
+    """
+    global _async_redis_pool
+
+    import aioredis
+
+    if not _async_redis_pool:
+        settings = get_redis_settings(config)
+        connection_kwargs = dict(
+            password=settings["password"],
+            socket_timeout=settings["socket_timeout"],
+            socket_keepalive=True,
+            health_check_interval=settings["health_check_interval"],
+            retry_on_timeout=True,
         )
 
-    return _redis_client
+        if settings["mode"] == "cluster":
+            raise Exception("redis cluster поддерживается только синхронным клиентом")
+
+        if settings["mode"] == "sentinel":
+            from aioredis.sentinel import Sentinel
+
+            sentinel = Sentinel(
+                [tuple(s) for s in settings["sentinels"]],
+                sentinel_kwargs={
+                    "password": settings.get("sentinel_password"),
+                    "socket_timeout": settings["socket_timeout"],
+                },
+            )
+            _async_redis_pool = sentinel.master_for(
+                settings["service_name"],
+                db=settings["db"],
+                max_connections=settings["max_connections"],
+                **connection_kwargs,
+            ).connection_pool
+        else:
+            _async_redis_pool = aioredis.BlockingConnectionPool(
+                host=settings["host"],
+                port=settings["port"],
+                db=settings["db"],
+                max_connections=settings["max_connections"],
+                timeout=settings["pool_timeout"],
+                **connection_kwargs,
+            )
+
+    return aioredis.Redis(connection_pool=_async_redis_pool)
+
+
+def get_accounts(config=None):
+    """
+    Аккаунты для session_keeper: config['accounts'] или единственный
+    аккаунт с верхнего уровня конфига. secret и paper по умолчанию общие.
+    """
+    if config is None:
+        config = get_config()
+
+    accounts = config.get('accounts') or [{
+        "username": config['username'],
+        "password": config['password'],
+    }]
+    return [
+        {"secret": config['secret'], "paper": config['paper'], **account}
+        for account in accounts
+    ]
+
+
+def new_ib_instance(config=None, account=None):
+    """
+    Отдельный экземпляр IbApi, сессия берется из общего RedisStorage.
+    account — один из get_accounts, по умолчанию аккаунт с верхнего уровня.
+    """
+    from ibkr_web_api import IbApi
+    from ibkr_web_api.session_storage import RedisStorage
+
+    if config is None:
+        config = get_config()
+    if account is None:
+        account = config
+
+    storage = RedisStorage(
+        session_name=account['username'],
+        redis_client=get_redis_client(config),
+        secret=account['secret']
+    )
+    return IbApi(account['username'], account['password'],
+                 session_storage=storage, paper=account['paper'],
+                 debug=False)
 
 
 def get_ib_instance(config=None):
     global _ib_instance
 
     if not _ib_instance:
+        _ib_instance = new_ib_instance(config)
+
+    return _ib_instance
+
+
+def new_rate_limiter(session, config=None):
+    """
+    Лимитер запросов в IBKR для сессии session.
+    None, если в конфиге rate_limit: false.
+    """
+    from rate_limit import RateLimiter, get_rate_limit_settings
+
+    if config is None:
+        config = get_config()
+
+    settings = get_rate_limit_settings(config)
+    if settings is None:
+        return None
+
+    redis_client = get_redis_client(config)
+    if not hasattr(redis_client, "register_script"):
+        # в redis-py 4.1 у RedisCluster нет Lua
+        return None
+
+    return RateLimiter(redis_client, session, **settings)
+
+
+def get_rate_limiter(config=None):
+    """
+    Общий для всех демонов лимитер запросов в IBKR, ключ — username сессии.
+    None, если в конфиге rate_limit: false.
+    """
+    from rate_limit import get_rate_limit_settings
+
+    global _rate_limiter
+
+    if not _rate_limiter:
         if config is None:
             config = get_config()
+        if get_rate_limit_settings(config) is None:
+            return None
+        _rate_limiter = new_rate_limiter(config['username'], config)
 
-        storage = RedisStorage(
-            session_name=config['username'],
-            redis_client=get_redis_client(config),
-            secret=config['secret']
-        )
-        _ib_instance = IbApi(config['username'], config['password'],
-                             session_storage=storage, paper=config['paper'],
-                             debug=False)
-
-    return _ib_instance
+    return _rate_limiter
@@ -0,0 +1,85 @@
+"""
+Конфлированные каналы сделок для медленных подписчиков.
+
+Для каждого интервала из conflation_intervals держится последнее сообщение
+по каждому инструменту, раз в интервал они публикуются в
+{symbol}:TRADES:{100ms|1s|...}. Сколько бы тиков ни пришло, в канал уходит
+не больше одного сообщения на инструмент за интервал, так что буферы
+медленных клиентов в Redis не растут. Полный поток в {symbol}:TRADES остается.
+"""
+import asyncio
+
+from termcolor import cprint
+
+_conflator = None
+
+
+def interval_label(interval):
+    if interval < 1:
+        return f"{int(round(interval * 1000))}ms"
+    return f"{interval:g}s"
+
+
+def get_conflated_channel(symbol, interval):
+    return f"{symbol}:TRADES:{interval_label(interval)}"
+
+
+class Conflator:
+    def __init__(self, intervals):
+        self.intervals = list(intervals)
+        # интервал -> {канал: последнее сообщение}
+        self._pending = {interval: {} for interval in self.intervals}
+        self.tasks = []  # asyncio держит задачи слабыми ссылками
+
+    def remove(self, symbol):
+        """
+        Забыть последние сообщения инструмента, от которого отписались.
+        """
+        for interval, pending in self._pending.items():
+            pending.pop(get_conflated_channel(symbol, interval), None)
+
+    def update(self, symbol, message):
+        for interval, pending in self._pending.items():
+            pending[get_conflated_channel(symbol, interval)] = message
+
+    async def flush(self, interval, redis_client):
+        pending = self._pending[interval]
+        if not pending:
+            return 0
+
+        self._pending[interval] = {}
+        pipe = redis_client.pipeline(transaction=False)
+        for channel, message in pending.items():
+            pipe.publish(channel, message)
+        await pipe.execute()
+        return len(pending)
+
+    async def run_tier(self, interval, get_redis_func):
+        redis_client = get_redis_func()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush(interval, redis_client)
+            except Exception as e:
+                cprint(f"conflation {interval_label(interval)} error {e}", "red")
+                await asyncio.sleep(3)
+                redis_client = get_redis_func()
+
+    def start(self, get_redis_func):
+        """
+        По задаче на каждый интервал.
+        """
+        self.tasks = [
+            asyncio.create_task(self.run_tier(interval, get_redis_func))
+            for interval in self.intervals
+        ]
+        return self.tasks
+
+
+def get_conflator(config):
+    global _conflator
+
+    if not _conflator:
+        _conflator = Conflator(config.get('conflation_intervals') or [])
+
+    return _conflator
@@ -88,9 +88,30 @@ function draw_chart(el, data, symbol) {
 }
 
 
-// Parse the Data
-d3.csv("./dash.csv").then( function(data) {
+// dash_server.py: snapshot + живые изменения по websocket.
+// Без него — как раньше, dash.csv, который перезаписывает get_bars.
+const DASH_SERVER = window.DASH_SERVER || `${location.hostname}:8765`
+const DASH_HOURS = 120
 
+const containers = {}
+
+
+function render(data, symbol) {
+  let container = containers[symbol]
+  if (!container) {
+    const element = document.createElement('h2')
+    element.textContent = symbol
+    document.body.append(element)
+
+    container = containers[symbol] = document.createElement('div')
+    document.body.append(container)
+  }
+  container.replaceChildren()
+  draw_chart(container, data, symbol)
+}
+
+
+function render_all(data) {
   const symbols = []
   for (const line of data) {
     if (symbols.indexOf(line.ticker) < 0) {
@@ -99,13 +120,95 @@ d3.csv("./dash.csv").then( function(data) {
   }
 
   for (const symbol of symbols.sort()) {
-    const element = document.createElement('h2')
-    element.textContent = symbol
-    document.body.append(element)
+    render(data, symbol)
+  }
+}
+
 
-    const svg_container = document.createElement('div')
-    document.body.append(svg_container)
-    draw_chart(svg_container, data, symbol)
+function to_rows(columns, rows) {
+  const data = rows.map(row => Object.fromEntries(row.map((v, i) => [columns[i], v])))
+  data.columns = columns
+  return data
+}
+
+
+function apply_cells(data, cells) {
+  const changed = new Set()
+  for (const row of to_rows(data.columns, cells)) {
+    const i = data.findIndex(d => d.ticker === row.ticker && d.group === row.group)
+    if (i >= 0) {
+      data[i] = row
+    } else {
+      data.push(row)
+      data.sort((a, b) => a.ticker.localeCompare(b.ticker) || a.group.localeCompare(b.group))
+    }
+    changed.add(row.ticker)
+  }
+
+  // окно сдвигается: старые часы выкидываем
+  for (const ticker of changed) {
+    const groups = data.filter(d => d.ticker === ticker).map(d => d.group)
+    const oldest = groups.slice(-DASH_HOURS)[0]
+    for (let i = data.length - 1; i >= 0; i--) {
+      if (data[i].ticker === ticker && data[i].group < oldest) {
+        data.splice(i, 1)
+      }
+    }
+  }
+  return changed
+}
+
+
+function connect(data, version) {
+  const ws = new WebSocket(`ws://${DASH_SERVER}/updates?since=${version}`)
+
+  ws.onmessage = function(event) {
+    const message = JSON.parse(event.data)
+    if (message.type === "reload") {
+      // сервер уже не помнит, что мы пропустили
+      location.reload()
+    } else if (message.type === "remove") {
+      for (let i = data.length - 1; i >= 0; i--) {
+        if (data[i].ticker === message.ticker) {
+          data.splice(i, 1)
+        }
+      }
+      if (containers[message.ticker]) {
+        containers[message.ticker].previousSibling.remove()
+        containers[message.ticker].remove()
+        delete containers[message.ticker]
+      }
+    } else if (message.type === "trim") {
+      // часы, ушедшие за окно дашборда
+      const changed = new Set()
+      for (let i = data.length - 1; i >= 0; i--) {
+        if (data[i].group < message.before) {
+          changed.add(data[i].ticker)
+          data.splice(i, 1)
+        }
+      }
+      for (const symbol of changed) {
+        render(data, symbol)
+      }
+    } else if (message.type === "cells") {
+      for (const symbol of apply_cells(data, message.cells)) {
+        render(data, symbol)
+      }
+    }
+    version = message.version
   }
 
-})
+  ws.onclose = function() {
+    setTimeout(() => connect(data, version), 3000)
+  }
+}
+
+
+fetch(`http://${DASH_SERVER}/snapshot`)
+  .then(response => response.json())
+  .then(snapshot => {
+    const data = to_rows(snapshot.columns, snapshot.rows)
+    render_all(data)
+    connect(data, snapshot.version)
+  })
+  .catch(() => d3.csv("./dash.csv").then(render_all))
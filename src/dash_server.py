@@ -0,0 +1,366 @@
+"""
+Живой дашборд по наличию баров вместо перезаписи dash.csv.
+
+Матрица статусов по часам (как в dash.csv) лежит в памяти. Изменения приходят
+из каналов {symbol}:BARS и раз в DASH_PUSH_SECONDS рассылаются браузерам
+по websocket — только изменившиеся ячейки. Раз в DASH_RESYNC_SECONDS матрица
+сверяется с Redis: так ловятся сообщения, потерянные при переподключении
+к Redis, заодно подхватывается список инструментов и сдвигается окно.
+
+    GET /snapshot          — вся матрица в JSON, с ETag (версия)
+    ws  /updates?since=N   — изменения после версии N, потом живые изменения
+
+    python dash_server.py config_local.yaml
+"""
+import asyncio
+import json
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlparse
+
+import click
+import orjson
+import websockets
+from termcolor import cprint
+
+from bars import (
+    DASH_STATUSES, dt_to_ts, get_key, get_line_status, ts_to_dt
+)
+from config import get_async_redis_client, get_config, get_redis_client, reload_instruments
+from utils import coro, get_traceback, startup_report
+
+# сколько часов истории показывать, как в dash.csv
+DASH_HOURS = 120
+
+DASH_PUSH_SECONDS = 0.5
+DASH_RESYNC_SECONDS = 300
+# pubsub.listen() падает по socket_timeout, пока в каналах тихо,
+# поэтому ждем сообщения сами, тишина — не ошибка
+DASH_SUBSCRIBER_POLL_SECONDS = 1
+
+# сколько последних пачек изменений помнить для клиентов с ?since=
+HISTORY_BATCHES = 200
+
+DEFAULT_PORT = 8765
+
+COLUMNS = ["ticker", "group"] + DASH_STATUSES
+
+
+def get_ticker(instrument):
+    # как в dash.csv, без key_prefix
+    return "{symbol}.{exchange}:TRADES".format(**instrument)
+
+
+def get_hour(ts):
+    return str(ts_to_dt(ts * 1000).replace(minute=0, second=0))
+
+
+def window_start():
+    start = datetime.utcnow() - timedelta(hours=DASH_HOURS)
+    return dt_to_ts(start.replace(minute=0, second=0, microsecond=0))
+
+
+class DashState:
+    def __init__(self):
+        self.minutes = {}  # ticker -> {ts минуты: статус}
+        self.cells = {}  # ticker -> {час: Counter статусов}
+        self.version = 0
+        self.history = deque(maxlen=HISTORY_BATCHES)  # (версия, json пачки)
+        self._dirty = set()  # (ticker, час)
+        self._snapshot = None  # (версия, json), считается по запросу
+
+    ###
+    # изменения
+    ###
+    def set_status(self, ticker, ts, status):
+        minutes = self.minutes.setdefault(ticker, {})
+        old = minutes.get(ts)
+        if old == status:
+            return
+
+        hour = get_hour(ts)
+        cell = self.cells.setdefault(ticker, {}).setdefault(hour, Counter())
+        if old:
+            cell[old] -= 1
+        if status:
+            cell[status] += 1
+            minutes[ts] = status
+        else:
+            minutes.pop(ts, None)
+        self._dirty.add((ticker, hour))
+
+    def replace_ticker(self, ticker, statuses):
+        """
+        Привести минуты инструмента к statuses (ts -> статус), как в Redis.
+        """
+        for ts in set(self.minutes.get(ticker, {})) - set(statuses):
+            self.set_status(ticker, ts, None)
+        for ts, status in statuses.items():
+            self.set_status(ticker, ts, status)
+
+    def _add_message(self, message):
+        self.version += 1
+        message["version"] = self.version
+        message = json.dumps(message)
+        self.history.append((self.version, message))
+        return message
+
+    def remove_ticker(self, ticker):
+        """
+        Забыть инструмент, сообщение для клиентов.
+        """
+        self.minutes.pop(ticker, None)
+        self.cells.pop(ticker, None)
+        self._dirty = {cell for cell in self._dirty if cell[0] != ticker}
+        return self._add_message({"type": "remove", "ticker": ticker})
+
+    def trim(self):
+        """
+        Выкинуть часы, ушедшие за окно. Сообщение для клиентов или None,
+        если выкидывать нечего.
+        """
+        start = window_start()
+        for ticker, minutes in self.minutes.items():
+            for ts in [ts for ts in minutes if ts < start]:
+                del minutes[ts]
+        start_hour = get_hour(start)
+        trimmed = False
+        for cells in self.cells.values():
+            for hour in [h for h in cells if h < start_hour]:
+                del cells[hour]
+                trimmed = True
+        # иначе выкинутая ячейка вернется к клиенту нулевой строкой
+        self._dirty = {cell for cell in self._dirty if cell[1] >= start_hour}
+        if not trimmed:
+            return None
+        return self._add_message({"type": "trim", "before": start_hour})
+
+    def row(self, ticker, hour):
+        cell = self.cells.get(ticker, {}).get(hour, Counter())
+        return [ticker, hour] + [cell[status] for status in DASH_STATUSES]
+
+    def take_changes(self):
+        """
+        Собрать изменившиеся ячейки в пачку с новой версией или None.
+        """
+        if not self._dirty:
+            return None
+        dirty, self._dirty = self._dirty, set()
+        return self._add_message({
+            "type": "cells",
+            "cells": [self.row(ticker, hour) for ticker, hour in sorted(dirty)],
+        })
+
+    ###
+    # чтение
+    ###
+    def snapshot(self):
+        if not self._snapshot or self._snapshot[0] != self.version:
+            rows = [
+                self.row(ticker, hour)
+                for ticker in sorted(self.cells)
+                for hour in sorted(self.cells[ticker])
+            ]
+            self._snapshot = (self.version, json.dumps({
+                "version": self.version, "columns": COLUMNS, "rows": rows,
+            }).encode())
+        return self._snapshot[1]
+
+    def changes_since(self, version):
+        """
+        Пачки после version или None, если они уже забыты.
+        """
+        if version == self.version:
+            return []
+        if not self.history or self.history[0][0] > version + 1:
+            return None
+        return [message for v, message in self.history if v > version]
+
+
+def load_statuses(instrument, redis_client):
+    """
+    Статусы минут инструмента за окно дашборда из Redis, до текущей минуты.
+    """
+    statuses = {}
+    rows = redis_client.zrangebyscore(
+        get_key(instrument), window_start(), dt_to_ts(datetime.utcnow()), withscores=True,
+    )
+    for line, score in rows:
+        try:
+            status = get_line_status(orjson.loads(line))
+        except ValueError:
+            status = "error"
+        statuses[int(score)] = status
+    return statuses
+
+
+class DashServer:
+    def __init__(self, config):
+        self.config = config
+        self.state = DashState()
+        self.clients = set()
+        self.tickers = {}  # ticker -> инструмент
+        self.tasks = []  # asyncio держит задачи слабыми ссылками
+
+    def start(self):
+        self.tasks = [
+            asyncio.create_task(self.run_subscriber()),
+            asyncio.create_task(self.run_pusher()),
+            asyncio.create_task(self.run_resync()),
+        ]
+        return self.tasks
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def resync(self):
+        """
+        Сверить матрицу с Redis. Чтение — в потоке синхронным клиентом.
+        """
+        reload_instruments()
+        instruments = {get_ticker(i): i for i in self.config['instruments']}
+        for ticker in set(self.tickers) - set(instruments):
+            websockets.broadcast(self.clients, self.state.remove_ticker(ticker))
+        self.tickers = instruments
+
+        redis_client = get_redis_client(self.config)
+        for ticker, instrument in instruments.items():
+            statuses = await asyncio.to_thread(load_statuses, instrument, redis_client)
+            self.state.replace_ticker(ticker, statuses)
+        message = self.state.trim()
+        if message:
+            websockets.broadcast(self.clients, message)
+
+    async def run_resync(self):
+        while True:
+            await asyncio.sleep(DASH_RESYNC_SECONDS)
+            try:
+                await self.resync()
+            except Exception as e:
+                cprint("resync error %s" % get_traceback(e), "red")
+
+    async def run_subscriber(self):
+        """
+        Статусы новых и исправленных минут из {symbol}:BARS.
+        """
+        while True:
+            pubsub = None
+            try:
+                redis_client = get_async_redis_client(self.config)
+                pubsub = redis_client.pubsub()
+                await pubsub.psubscribe("*:BARS")
+                while True:
+                    message = await pubsub.get_message(timeout=DASH_SUBSCRIBER_POLL_SECONDS)
+                    if message and message["type"] == "pmessage":
+                        self.on_bar(message["data"])
+            except Exception as e:
+                cprint("redis subscriber error %s" % e, "red")
+                if pubsub:
+                    # вернуть соединение в пул
+                    await pubsub.reset()
+                await asyncio.sleep(3)
+
+    def on_bar(self, data):
+        try:
+            bar = orjson.loads(data)
+            ticker = bar["symbol"] + ":TRADES"
+            ts = dt_to_ts(datetime.strptime(bar["dt"], "%Y-%m-%d %H:%M:%S"))
+        except (ValueError, KeyError):
+            return
+        if ticker in self.tickers and window_start() <= ts <= dt_to_ts(datetime.utcnow()):
+            self.state.set_status(ticker, ts, get_line_status(bar))
+
+    async def run_pusher(self):
+        while True:
+            await asyncio.sleep(DASH_PUSH_SECONDS)
+            message = self.state.take_changes()
+            if message and self.clients:
+                websockets.broadcast(self.clients, message)
+
+    ###
+    # HTTP и websocket
+    ###
+    async def process_request(self, path, request_headers):
+        url = urlparse(path)
+        if url.path.rstrip("/").endswith("/updates"):
+            # websocket handshake
+            return None
+
+        if not url.path.rstrip("/").endswith("/snapshot"):
+            return HTTPStatus.NOT_FOUND, [], b"not found\n"
+
+        etag = f'"{self.state.version}"'
+        headers = [
+            ("ETag", etag),
+            ("Cache-Control", "no-cache"),
+            ("Access-Control-Allow-Origin", "*"),
+            ("Access-Control-Expose-Headers", "ETag"),
+        ]
+        if request_headers.get("If-None-Match") == etag:
+            return HTTPStatus.NOT_MODIFIED, headers, b""
+
+        body = self.state.snapshot()
+        headers.append(("Content-Type", "application/json"))
+        return HTTPStatus.OK, headers, body
+
+    async def handler(self, websocket, path=None):
+        query = parse_qs(urlparse(path or websocket.path).query)
+        try:
+            since = int(query.get("since", ["-1"])[0])
+        except ValueError:
+            since = -1
+
+        # что клиент пропустил между snapshot и подключением. broadcast
+        # только кладет в буфер соединения, без await: пушер не вклинится
+        # между пропущенным и добавлением в clients
+        missed = self.state.changes_since(since)
+        if missed is None:
+            missed = [json.dumps({"type": "reload", "version": self.state.version})]
+        for message in missed:
+            websockets.broadcast([websocket], message)
+
+        self.clients.add(websocket)
+        try:
+            await websocket.wait_closed()
+        finally:
+            self.clients.discard(websocket)
+
+
+@click.command()
+@coro
+@click.argument('config_path', type=click.Path(exists=True))
+async def main(config_path):
+    config = get_config(config_path)
+    settings = config.get('dash_server') or {}
+
+    server = DashServer(config)
+    await server.resync()
+    # первая загрузка — это не изменения
+    server.state.take_changes()
+    server.state.history.clear()
+
+    server.start()
+
+    host = settings.get('host', '0.0.0.0')
+    port = settings.get('port', DEFAULT_PORT)
+    try:
+        async with websockets.serve(
+            server.handler, host, port,
+            process_request=server.process_request,
+        ):
+            startup_report("dash_server")
+            cprint(f"dash server http://{host}:{port}/snapshot", "green")
+            await asyncio.Future()
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("DONE")
@@ -1,19 +1,31 @@
-import json
+import asyncio
 import sys
 import logging
+import threading
 
 import click
 import orjson
-import pandas_market_calendars as mcal
-from time import sleep
-from random import shuffle
-from functools import cache
+from random import shuffle, uniform
+from functools import partial
 from collections import Counter
 from termcolor import cprint
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timedelta
 from os.path import abspath, join, dirname
 
-from config import get_config, get_ib_instance, get_redis_client
+from bars import (
+    apply_bars, build_grid, dt_to_ts, get_exchange_schedule, get_key,
+    get_line_status, get_ws_bar_instruments, load_old_lines, replace_data,
+    save_grid, ts_to_dt
+)
+from calendars import set_cache_dir, warm_up
+from config import (
+    get_config, get_rate_limiter, get_redis_client, new_ib_instance,
+    reload_instruments
+)
+from profiling import SamplingProfiler, stage, timer
+from rate_limit import BACKFILL, LIVE, is_pacing_error
+from rollups import update_rollups
+from utils import coro, startup_report
 
 log = logging.getLogger("loader")
 
@@ -25,14 +37,36 @@ logging.basicConfig(
 )
 
 
-EXCHANGE_SCHEDULE = {
-    "NASDAQ": "NASDAQ",
-    "NYMEX": "NYSE",
-    "NYSE": "NYSE",
-    "ARCA": "NYSE",
-    "GLOBEX": "CME_Rate",
+# Расписание минутной итерации, переопределяется в config['bars_schedule']
+SCHEDULE_DEFAULTS = {
+    "loader_offset": 2,  # секунд после начала минуты до старта загрузки
+    "dash_offset": 30,  # секунд после начала минуты до обновления дашборда
+    "deadline": 55,  # к этой секунде минуты всё должно закончиться
+    "instrument_timeout": 20,  # максимум секунд на один инструмент
+    "concurrency": 8,  # сколько инструментов грузить одновременно
+    "retry_base": 0.5,  # первая пауза между попытками, секунд
+    "retry_max": 5,  # максимальная пауза между попытками
 }
 
+# Сколько минут после закрытия биржи грузить по-обычному,
+# чтобы успеть поправить последние бары сессии
+CLOSED_GRACE_MINUTES = 5
+
+# Запрос до стольких минут считается живым баром, длиннее — догрузкой истории
+LIVE_PERIOD_MINUTES = 15
+
+# Сколько секунд ждать токен лимитера перед запросом истории
+RATE_LIMIT_TIMEOUT = 10
+
+# bars_source: websocket — живые бары приходят из get_trades_async (smh),
+# get_bars догружает по HTTP только то, что не пришло за BARS_WS_LAG_MINUTES
+BARS_WS_LAG_MINUTES = 2
+
+_thread_local = threading.local()
+
+# ключ инструмента -> (ts следующего открытия, ts до которого уже помечено closed)
+_closed_until = {}
+
 
 def get_stats_for_hour(data):
     cnt = Counter()
@@ -43,16 +77,7 @@ def get_stats_for_hour(data):
         except ValueError:
             cnt["error"] += 1
             continue
-        if j.get("error"):
-            cnt["error"] += 1
-        elif j.get("closed"):
-            cnt["closed"] += 1
-        elif j.get("empty"):
-            cnt["empty"] += 1
-        elif j.get("fix") or j.get("late"):
-            cnt["fix"] += 1
-        else:
-            cnt["ok"] += 1
+        cnt[get_line_status(j)] += 1
 
     return cnt
 
@@ -61,6 +86,15 @@ def update_dash(instruments, csv_path, redis_client):
     """
     Обновление CSV со статусами по часам.
     """
+    with stage("update_dash"):
+        dash_csv_data = get_dash_csv_data(instruments, redis_client)
+
+    with stage("csv_write"):
+        with open(csv_path, "w") as f:
+            f.write(dash_csv_data)
+
+
+def get_dash_csv_data(instruments, redis_client):
     end = datetime.utcnow()
     start = end - timedelta(hours=120)
     start = start.replace(minute=0, second=0, microsecond=0)
@@ -69,6 +103,7 @@ def update_dash(instruments, csv_path, redis_client):
 
     for instrument in instruments:
         key = get_key(instrument)
+        ticker = "{symbol}.{exchange}:TRADES".format(**instrument)
 
         cur_hour_interval = start
         for n in range(300):
@@ -80,7 +115,7 @@ def update_dash(instruments, csv_path, redis_client):
             )
             stats = get_stats_for_hour(data)
             dash_csv_data += (
-                f"{key},{cur_hour_interval},"
+                f"{ticker},{cur_hour_interval},"
                 f"{stats['ok']},{stats['closed']},"
                 f"{stats['error']},{stats['fix']},"
                 f"{stats['empty']}\n"
@@ -90,108 +125,36 @@ def update_dash(instruments, csv_path, redis_client):
             if cur_hour_interval > datetime.utcnow():
                 break
 
-    with open(csv_path, "w") as f:
-        f.write(dash_csv_data)
-
-
-def dt_range(start, end, step=timedelta(minutes=1)):
-    curr = start
-    while curr <= end:
-        yield curr
-        curr += step
-
-
-def ts_to_dt(ts):
-    return datetime.utcfromtimestamp(ts / 1000)
-
-
-def dt_to_ts(dt):
-    return int(dt.replace(tzinfo=timezone.utc).timestamp())
-
-
-def get_key(instrument):
-    # Всё правильно, в базу бары складываются с ключом TRADES
-    return "{symbol}.{exchange}:TRADES".format(**instrument)
-
-
-def replace_data(instrument, line, ts, redis_client):
-    """
-    Запись в базу с заменой старых данных.
-    """
-    key = get_key(instrument)
-    line_str = json.dumps(line, indent=None, separators=(',', ':'), default=str)
-    dt = ts_to_dt(ts*1000)
-    cprint(f"{key}, {ts}, {dt}, {line_str}", "white")
-    redis_client.zremrangebyscore(key, ts, ts)
-    redis_client.zadd(key, {line_str: ts})
-
-    symbol = "{symbol}.{exchange}".format(**instrument)
-    line["conid"] = instrument["conid"]
-    line["symbol"] = symbol
-    line_str = json.dumps(line, indent=None, separators=(',', ':'), default=str)
-    redis_client.publish(f"{symbol}:BARS", line_str)
-
-
-@cache
-def get_calendar_and_schedule(exchange):
-    """
-    Календарь и расписание для биржи.
-    """
-    calendar = mcal.get_calendar(EXCHANGE_SCHEDULE[exchange])
-
-    # нужно покрыть вперед и назад все возможные выходные
-    start = datetime.utcnow() - timedelta(days=10)
-    end = datetime.utcnow() + timedelta(days=100)
-
-    # TODO: убрать хардкодинг
-    if EXCHANGE_SCHEDULE[exchange] in ["NYSE", "NASDAQ"]:
-        schedule = calendar.schedule(start, end, start="pre", end="post")
-    else:
-        schedule = calendar.schedule(start, end)
-
-    return calendar, schedule
-
-
-@cache
-def check_open_time(exchange, cur_interval):
-    """
-    Открыта ли эта биржа в указанный момент.
-    """
-    calendar, schedule = get_calendar_and_schedule(exchange)
-    cur_interval_utc = cur_interval.replace(tzinfo=timezone.utc)
-    try:
-        return calendar.open_at_time(schedule, cur_interval_utc)
-    except ValueError as e:
-        print(schedule)
-        raise e
-
-
-def format_valid_interval(interval):
-    return {
-        "dt": datetime.strftime(interval["dt"], "%Y-%m-%d %H:%M:%S"),
-        "o": interval["o"],
-        "h": interval["h"],
-        "l": interval["l"],
-        "c": interval["c"],
-        "vol": interval["v"],
-        # "rth": int(interval["rth"]),
-    }
+    return dash_csv_data
 
 
 def load_intervals_from_ibkr(ib, instrument, period, data_grid):
     # Запрос в IBKR
     q = f"?conid={instrument['conid']}&period={period}min&bar=1min&outsideRth=true"
+
+    # живые бары важнее догрузки истории
+    limiter = get_rate_limiter()
+    priority = LIVE if period <= LIVE_PERIOD_MINUTES else BACKFILL
+    with stage("rate_limit"):
+        if limiter and not limiter.acquire(priority, RATE_LIMIT_TIMEOUT):
+            raise Exception(f"IBKR rate limit, {priority} request skipped")
+
     try:
         ib.reset_session()
         ib.load_session()
         history_url = "%s/iserver/marketdata/history" % ib.get_portal_url()
-        res_json = ib.iserver_request(history_url + q, "GET")
+        with stage("ibkr_request"):
+            res_json = ib.iserver_request(history_url + q, "GET")
         print(res_json)
         print('='*80)
     except Exception as e:
         cprint(f"ERROR requests {e}", "red")
         raise e
 
+    if limiter and is_pacing_error(res_json):
+        limiter.report_rejection()
+        raise Exception(f"IBKR pacing {res_json}")
+
     # TODO: определять ситуацию, когда данные в начале торгового дня приходят
     # TODO: только за прошлый день (значит за этот день данных еще не было)
 
@@ -202,41 +165,7 @@ def load_intervals_from_ibkr(ib, instrument, period, data_grid):
     # во все ячейки сетки, когда биржа уже была открыта.
 
     try:
-        data = res_json.get("data")
-        # print(data)
-
-        mnt = timedelta(minutes=1)
-        prev_dt = None
-        for interval in data:
-            ts = interval["t"] // 1000
-
-            dt = ts_to_dt(interval["t"])
-            # cprint(dt, "green")
-
-            # Если перед этим интервалом был гэп — навставлять EMPTY
-            if dt and prev_dt and dt - prev_dt > mnt:
-                cprint("large gap", "blue")
-                for gap_dt in dt_range(prev_dt + mnt, dt - mnt):
-                    if check_open_time(instrument["exchange"], gap_dt):
-                        # cprint(f"{gap_dt} open, but no data", "yellow")
-                        gap_ts = dt_to_ts(gap_dt)
-                        if gap_ts in data_grid:
-                            interval["dt"] = gap_dt
-                            data_grid[gap_ts]["new"] = {
-                                "dt": datetime.strftime(gap_dt, "%Y-%m-%d %H:%M:%S"),
-                                "empty": 1,
-                            }
-                            data_grid[gap_ts]["t"] = gap_ts * 1000
-
-            if ts in data_grid:
-                interval["dt"] = dt
-                data_grid[ts]["new"] = format_valid_interval(interval)
-                data_grid[ts]["t"] = interval["t"]
-            else:
-                log.debug(f"Time is not in data_grid {ts} {dt}")
-            prev_dt = dt
-
-        # print('\n\n\n')
+        apply_bars(instrument, res_json.get("data"), data_grid)
     except Exception as e:
         cprint(f"ERROR: {res_json} {e}", "yellow")
         raise e
@@ -311,66 +240,17 @@ def update_instrument(ib, interval_dt, symbol, redis_client):
     cur_minute = datetime.utcnow().replace(second=0, microsecond=0)
     start = cur_minute - timedelta(days=3)
 
-    # Пустая сетка интервалов с расписанием биржи
-    data_grid = {}
-    for cur_interval in dt_range(start, interval_dt):
-        is_it_open = check_open_time(symbol["exchange"], cur_interval)
-        data_grid[dt_to_ts(cur_interval)] = {
-            "dt": datetime.strftime(cur_interval, "%Y-%m-%d %H:%M:%S"),
-            "is_it_open": is_it_open,
-        }
+    data_grid = build_grid(symbol, start, interval_dt)
 
     # Интервалы в базе данных от start до конца
-    key = get_key(symbol)
-    data_in_db = redis_client.zrangebyscore(key, dt_to_ts(start), 10 ** 10)
-
-    # Положить интервалы из базы в сетку
-    for line in data_in_db:
-        line = line.decode()
-        try:
-            line_data = orjson.loads(line)
-        except orjson.JSONDecodeError:
-            log.error(f"JSONDecodeError: {line}")
-            return False
-        dt = datetime.strptime(line_data["dt"], "%Y-%m-%d %H:%M:%S")
-        ts = dt_to_ts(dt)
-        if ts in data_grid:
-            data_grid[ts]["old"] = line_data
+    if not load_old_lines(symbol, data_grid, start, redis_client):
+        return False
 
     # Метод заполняет пробелы из IBKR или флагом "CLOSED"
-    data_grid = fill_gaps(ib, symbol, data_grid)
+    with stage("fill_gaps"):
+        data_grid = fill_gaps(ib, symbol, data_grid)
 
-    # # print(json.dumps(data_grid, indent=2, default=str))
-    # for line in data_grid.values():
-    #     print("old:", line.get("old"), "  new:", line.get("new"))
-    # sys.exit()
-
-    # Найти различачающиеся данные и сохранить или вывести ошибку
-    for score, line in data_grid.items():
-
-        # Уже были данные
-        if "old" in line:
-            # Но теперь есть другие данные
-            old_line = line["old"]
-            old_line.pop('late', None)
-            old_line.pop('fix', None)
-            old_line.pop('avg', None)
-            old_line.pop('cnt', None)
-            old_line.pop('rth', None)
-            if "new" in line and line["new"] != old_line:
-                new_line = line["new"]
-                new_line["fix"] = 1
-                replace_data(symbol, new_line, score, redis_client)
-
-        # Данных не было
-        else:
-            if new_line := line.get("new"):
-                # Если данные пришли не real-time, то ставлю флаг LATE
-                if datetime.strptime(line["dt"], "%Y-%m-%d %H:%M:%S") < interval_dt:
-                    new_line["late"] = 1
-                replace_data(symbol, new_line, score, redis_client)
-            else:
-                log.debug("Данных всё нет и нет")
+    save_grid(symbol, data_grid, interval_dt, redis_client)
 
     current_interval_data = data_grid[dt_to_ts(interval_dt)]
 
@@ -381,84 +261,279 @@ def update_instrument(ib, interval_dt, symbol, redis_client):
     return done
 
 
-def loader(ib, dt_start, instruments, redis_client):
+def get_closed_span(symbol, interval_dt):
+    """
+    Если биржа закрыта давно (дольше CLOSED_GRACE_MINUTES),
+    вернуть (начало, следующее открытие) в unix-секундах, иначе None.
+    """
+    schedule = get_exchange_schedule(symbol["exchange"])
+    ts = dt_to_ts(interval_dt)
+    try:
+        if schedule.is_open(ts):
+            return None
+    except ValueError:
+        return None
+
+    last_close = schedule.last_close(ts)
+    next_open = schedule.next_open(ts)
+    if last_close is None or next_open is None:
+        return None
+    if ts - last_close < CLOSED_GRACE_MINUTES * 60:
+        return None
+
+    return ts, next_open
+
+
+def mark_closed_span(symbol, start_ts, end_ts, redis_client):
     """
-    Грузить интервал, пока не загрузится или не наступит новый интервал.
+    Пометить closed минуты [start_ts, end_ts) так же, как обычные бары:
+    через replace_data, с публикацией в {symbol}:BARS.
+    Минуты, где уже есть нормальные данные, не трогаем.
     """
-    timeout = 10  # максимальное время на загрузку одного инструмента
-    sleep_time = 3
+    key = get_key(symbol)
+    with stage("closed_span"):
+        existing = set()
+        for line, score in redis_client.zrangebyscore(key, start_ts, end_ts - 1, withscores=True):
+            if b'"error"' not in line:
+                existing.add(int(score))
+
+        marked = 0
+        for ts in range(start_ts, end_ts, 60):
+            if ts not in existing:
+                dt = datetime.strftime(ts_to_dt(ts * 1000), "%Y-%m-%d %H:%M:%S")
+                replace_data(symbol, {"dt": dt, "closed": 1}, ts, redis_client)
+                marked += 1
+
+    if marked:
+        cprint(f"{key} закрыт, помечено {marked} минут", "blue")
+
+
+def skip_closed(symbol, interval_dt, redis_client):
+    """
+    True, если инструмент сейчас грузить не надо: биржа закрыта давно.
+    Минуты закрытой сессии помечаются по мере наступления, не вперед.
+    """
+    key = get_key(symbol)
+    ts = dt_to_ts(interval_dt)
+    next_open, marked_until = _closed_until.get(key, (0, 0))
+
+    if ts >= next_open:
+        span = get_closed_span(symbol, interval_dt)
+        if not span:
+            return False
+        marked_until, next_open = span
+
+    if marked_until <= ts:
+        mark_closed_span(symbol, marked_until, ts + 60, redis_client)
+    _closed_until[key] = (next_open, ts + 60)
+    return True
+
+
+def write_error(symbol, interval_dt, code, redis_client):
+    line_data = {
+        "dt": datetime.strftime(interval_dt, "%Y-%m-%d %H:%M:%S"),
+        "error": code,
+    }
+    replace_data(symbol, line_data, dt_to_ts(interval_dt), redis_client)
+    # если ошибка затерла бар, старшие таймфреймы тоже надо пересчитать
+    update_rollups(symbol, [dt_to_ts(interval_dt)], redis_client)
 
+
+def get_thread_ib(config):
+    """
+    Свой IbApi на каждый поток: сессия общая через Redis,
+    а requests.Session между потоками лучше не делить.
+    """
+    if getattr(_thread_local, "ib", None) is None:
+        _thread_local.ib = new_ib_instance(config)
+    return _thread_local.ib
+
+
+def get_schedule_settings(config):
+    return {**SCHEDULE_DEFAULTS, **(config.get("bars_schedule") or {})}
+
+
+def retry_delay(attempt, settings):
+    """
+    Экспоненциальная пауза с джиттером, чтобы ретраи не шли пачкой.
+    """
+    delay = min(settings["retry_max"], settings["retry_base"] * 2 ** attempt)
+    return delay * uniform(0.5, 1)
+
+
+async def sleep_until(dt):
+    await asyncio.sleep(max(0.0, (dt - datetime.utcnow()).total_seconds()))
+
+
+async def load_instrument(get_ib, interval_dt, symbol, redis_client, settings, deadline):
+    """
+    Грузить один инструмент с ретраями, пока не загрузится
+    или не выйдет время на инструмент.
+    """
+    started = datetime.utcnow()
+    timeout = min(deadline, started + timedelta(seconds=settings["instrument_timeout"]))
+
+    attempt = 0
+    while True:
+        try:
+            if await asyncio.to_thread(
+                lambda: update_instrument(get_ib(), interval_dt, symbol, redis_client)
+            ):
+                # Успешно загрузилось
+                return True
+        except Exception as e:
+            cprint(f"ERROR load_interval {e}", "yellow")
+            log.exception(e)
+
+        delay = retry_delay(attempt, settings)
+        attempt += 1
+
+        # Если интервал так и не загрузился — записать ошибку
+        if datetime.utcnow() + timedelta(seconds=delay) >= timeout:
+            cprint(f"ERROR интервал долго не грузится {get_key(symbol)}", "red")
+            await asyncio.to_thread(write_error, symbol, interval_dt, 2, redis_client)
+            return False
+
+        # Перерыв после неудачной попытки
+        await asyncio.sleep(delay)
+
+
+async def loader(get_ib, dt_start, instruments, redis_client, settings=SCHEDULE_DEFAULTS,
+                 lag_minutes=0):
+    """
+    Грузить интервал по всем инструментам параллельно,
+    пока не загрузится или не наступит дедлайн минуты.
+    lag_minutes — на сколько минут отстать от текущей,
+    если свежие бары приходят по websocket.
+    """
     # Какой интервал грузить
     cur_minute = dt_start.replace(second=0, microsecond=0)
-    interval_dt = cur_minute - timedelta(minutes=1)
+    interval_dt = cur_minute - timedelta(minutes=1 + lag_minutes)
+    deadline = cur_minute + timedelta(seconds=settings["deadline"])
 
-    # Перемешиваю, чтобы при залипании первого инструмента не застряли все
+    # Закрытые биржи не трогаем до следующего открытия
+    instruments = [
+        symbol for symbol in instruments
+        if not await asyncio.to_thread(skip_closed, symbol, interval_dt, redis_client)
+    ]
+
+    # Перемешиваю, чтобы при залипании первых инструментов не ждали все
     shuffle(instruments)
 
-    for symbol in instruments:
-        while True:
-            try:
-                if update_instrument(ib, interval_dt, symbol, redis_client):
-                    # Успешно загрузилось
-                    break
-            except Exception as e:
-                cprint(f"ERROR load_interval {e}", "yellow")
-                log.exception(e)
-
-            dt = datetime.utcnow()
-
-            # Если интервал так и не загрузился — записать ошибку
-
-            if dt - dt_start > timedelta(seconds=timeout):
-                cprint(f"ERROR интервал долго не грузится", "red")
-                line_data = {
-                    "dt": datetime.strftime(interval_dt, "%Y-%m-%d %H:%M:%S"),
-                    "error": 2,
-                }
-                replace_data(symbol, line_data, dt_to_ts(interval_dt), redis_client)
+    semaphore = asyncio.Semaphore(settings["concurrency"])
 
-                # Прекращаем грузить инструмент
-                break
+    async def limited(symbol):
+        async with semaphore:
+            return await load_instrument(
+                get_ib, interval_dt, symbol, redis_client, settings, deadline
+            )
 
-            if dt.minute != dt_start.minute:
-                cprint("ERROR пора грузить новый интервал", "red")
-                line_data = {
-                    "dt": datetime.strftime(interval_dt, "%Y-%m-%d %H:%M:%S"),
-                    "error": 3,
-                }
-                replace_data(symbol, line_data, dt_to_ts(interval_dt), redis_client)
+    tasks = {asyncio.create_task(limited(symbol)): symbol for symbol in instruments}
+    if not tasks:
+        return
 
-                # Прекращаем грузить данный интервал
-                return
+    timeout = max(0.0, (deadline - datetime.utcnow()).total_seconds())
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
 
-            # Перерыв после неудачной попытки
-            sleep(sleep_time)
+    for task in pending:
+        # Поток с запросом не прервать, но результат уже не ждем
+        task.cancel()
+        symbol = tasks[task]
+        cprint(f"ERROR пора грузить новый интервал {get_key(symbol)}", "red")
+        await asyncio.to_thread(write_error, symbol, interval_dt, 3, redis_client)
+
+
+async def load_bars(get_ib, dt, http_instruments, ws_instruments, redis_client, settings):
+    """
+    Загрузка минуты для обеих групп инструментов, секунды от dt до конца.
+    """
+    with stage("loader"):
+        await asyncio.gather(
+            loader(get_ib, dt, http_instruments, redis_client, settings),
+            loader(get_ib, dt, ws_instruments, redis_client, settings,
+                   lag_minutes=BARS_WS_LAG_MINUTES),
+        )
+    return (datetime.utcnow() - dt).total_seconds()
+
+
+async def refresh_dash(instruments, csv_path, redis_client, start_at, deadline):
+    if not csv_path:
+        return
+    await sleep_until(start_at)
+    timeout = max(0.0, (deadline - datetime.utcnow()).total_seconds())
+    try:
+        await asyncio.wait_for(
+            asyncio.to_thread(update_dash, list(instruments), csv_path, redis_client),
+            timeout,
+        )
+    except asyncio.TimeoutError:
+        cprint("ERROR дашборд не успел обновиться", "red")
 
 
 @click.command()
+@coro
 @click.argument('config_path', type=click.Path(exists=True))
-def main(config_path):
+async def main(config_path):
     config = get_config(config_path)
-    ib = get_ib_instance(config)
+    settings = get_schedule_settings(config)
     base_dir = abspath(dirname(__file__))
-    csv_path = abspath(join(base_dir, config['dashboard_csv_path']))
+    # без dashboard_csv_path дашборд обслуживает dash_server.py
+    csv_path = None
+    if config.get('dashboard_csv_path'):
+        csv_path = abspath(join(base_dir, config['dashboard_csv_path']))
 
-    prev_dt = datetime(2000, 1, 1)
     redis_client = get_redis_client(config)
+    get_ib = partial(get_thread_ib, config)
+
+    # Расписания бирж с диска или пересчет до первой минуты
+    set_cache_dir(abspath(join(base_dir, config.get('calendar_cache_dir', 'cache'))))
+    warm_up(i["exchange"] for i in config['instruments'])
+    startup_report("get_bars")
+
+    # TRADIS_PROFILE=1 или kill -USR1 <pid>
+    profiler = SamplingProfiler.from_env()
+    profiler.install_toggle()
 
     while True:
+        # Проснуться через loader_offset секунд после начала следующей минуты
+        next_minute = datetime.utcnow().replace(second=0, microsecond=0) + timedelta(minutes=1)
+        await sleep_until(next_minute + timedelta(seconds=settings["loader_offset"]))
+
+        # Начать загрузку нового минутного интервала
         dt = datetime.utcnow()
-        if dt.minute != prev_dt.minute and dt.second > 10:
-            # Начать загрузку нового минутного интервала
-            prev_dt = dt
-            loader(ib, dt, config['instruments'], redis_client)
-            update_dash(config['instruments'], csv_path, redis_client)
-            # redis_client.close()
-            print()
-            print("-------- конец итерации ---------", datetime.utcnow())
-            print()
-        else:
-            sleep(1)
+        deadline = next_minute + timedelta(seconds=settings["deadline"])
+        timer.reset()
+        profiler.start_iteration()
+
+        # Состав инструментов мог поменяться в конфиге,
+        # новые просто попадут в этот же цикл загрузки.
+        added, removed = reload_instruments()
+        for instrument in added:
+            cprint(f"Новый инструмент {get_key(instrument)}", "green")
+        for instrument in removed:
+            cprint(f"Инструмент удален {get_key(instrument)}", "yellow")
+
+        # Живые бары части инструментов приходят по websocket,
+        # для них только догрузка того, что не пришло.
+        ws_instruments = get_ws_bar_instruments(config)
+        http_instruments = [i for i in config['instruments'] if i not in ws_instruments]
+
+        # дашборд ждет своей секунды минуты, в длительность загрузки
+        # (и порог профилировщика) это ожидание не входит
+        duration, _ = await asyncio.gather(
+            load_bars(get_ib, dt, http_instruments, ws_instruments, redis_client, settings),
+            refresh_dash(
+                config['instruments'], csv_path, redis_client,
+                next_minute + timedelta(seconds=settings["dash_offset"]),
+                deadline,
+            ),
+        )
+        profiler.finish_iteration(duration, name="loader")
+        print()
+        print("-------- конец итерации ---------", datetime.utcnow())
+        print(f"загрузка {duration:.1f}s, по стадиям:")
+        print(timer.report())
+        print()
 
 
 if __name__ == "__main__":
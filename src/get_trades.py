@@ -7,7 +7,6 @@ import time
 from datetime import datetime
 
 import click
-import websocket
 from termcolor import cprint
 
 from config import get_redis_client, get_config, get_ib_instance
@@ -57,6 +56,8 @@ def parse_data(d, instruments, redis_client):
 
 
 def worker(config, hb_queue, data_queue):
+    import websocket
+
     print(config)
     ib = get_ib_instance(config)
 
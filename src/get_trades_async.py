@@ -1,18 +1,35 @@
 import asyncio
 import json
+import signal
 import time
 from datetime import datetime
 from functools import partial
+from os.path import abspath, dirname, join
 
-import aioredis
 import websockets
 import click
 from termcolor import cprint
 from websockets.client import WebSocketClientProtocol
 from websockets.exceptions import ConnectionClosedOK, ConnectionClosed
 
-from config import get_ib_instance, get_config
-from utils import coro, get_async_redis_client, get_traceback
+from account_state import get_account_state
+from bars import get_ws_bar_instruments, merge_bars, settle_delay
+from calendars import set_cache_dir
+from config import (
+    get_async_redis_client, get_config, get_ib_instance, get_redis_client,
+    redis_key, reload_instruments
+)
+from conflation import get_conflator
+from latency import (
+    REPORT_SECONDS, FeedLagError, get_latency_estimator, now_ms, parse_server_ms
+)
+from rate_limit import LIVE, AsyncRateLimiter, get_rate_limit_settings, is_pacing_error
+from sequence import HISTORY_SIZE, Sequencer
+from snapshot import (
+    MARKET_DATA_FIELDS, SNAPSHOT_FLUSH_SECONDS, get_snapshot_store, parse_number
+)
+from tick_archive import FLUSH_SECONDS, FSYNC_SECONDS, get_tick_archive
+from utils import coro, get_traceback, startup_report
 
 
 # как часто слать tic
@@ -22,6 +39,26 @@ TIC_EVERY_SECONDS = 60
 # если дольше, то считаем что сокет сломался
 RECV_TIMEOUT = 15
 
+# как часто проверять, не поменялся ли список инструментов в конфиге
+INSTRUMENTS_CHECK_SECONDS = 5
+
+# параметры подписки smd: последняя сделка и лучшие bid/ask
+SMD_ARGS = json.dumps({"fields": MARKET_DATA_FIELDS}, separators=(',', ':'))
+
+# параметры подписки smh: минутные бары за последний час, потом обновления
+SMH_ARGS = json.dumps({
+    "period": "1h",
+    "bar": "1min",
+    "outsideRth": True,
+    "source": "trades",
+    "format": "%o/%c/%h/%l/%v",
+}, separators=(',', ':'))
+
+
+def get_redis_func(config):
+    # клиенты на общем пуле, новый клиент после ошибки стоит копейки
+    return partial(get_async_redis_client, config)
+
 
 class IbkrWebsocketClient(WebSocketClientProtocol):
     # присваивается в init
@@ -29,6 +66,12 @@ class IbkrWebsocketClient(WebSocketClientProtocol):
     config = None
     instruments_by_conid = None
     get_redis_func = None
+    snapshots = None
+    conflator = None
+    account_state = None
+    archive = None
+    latency = None
+    rate_limiter = None  # None, если лимитер выключен
 
     current_time_seconds = time.time()  # обновляется при каждом recv
     authenticated = False
@@ -36,9 +79,14 @@ class IbkrWebsocketClient(WebSocketClientProtocol):
     # protected
     _last_data_ts = {}  # когда приходили последние данные по инструментам
     _last_heartbeat_seconds = 0  # когда приходил последний ech+hb
-    _last_messages_ts = 0  # time() последнего recv, пока не используется
+    _last_messages_ts = 0  # time() последнего recv, от него считаются задержки
+    _last_latency_report = 0  # когда последний раз публиковали задержки
     _last_tic_seconds = 0  # чтобы слать tic каждые TIC_EVERY_SECONDS
+    _last_instruments_check = 0  # когда последний раз перечитывали конфиг
     _redis_client = None  # создается в init
+    _history_conids = None  # на что подписаны smh, conid -> serverId или None
+    _pending_bars = {}  # conid -> {t: бар}, ждут записи в Redis
+    _history_tasks = {}  # conid -> задача, которая пишет бары
 
     def init(self, ib, config):
         """
@@ -47,22 +95,71 @@ class IbkrWebsocketClient(WebSocketClientProtocol):
         self.ib = ib
         self.config = config
         self.instruments_by_conid = {i["conid"]: i for i in config['instruments']}
-        self.get_redis_func = partial(
-            get_async_redis_client,
-            config['redis']['host'],
-            config['redis']['port'],
-            config['redis']['db'],
-            config['redis']['password'],
-        )
+        self.get_redis_func = get_redis_func(config)
+        self.snapshots = get_snapshot_store(config)
+        self.conflator = get_conflator(config)
+        self.account_state = get_account_state(self.get_redis_func)
+        self.archive = get_tick_archive(config)
+        self._history_conids = {}
+        self.latency = get_latency_estimator(config)
+        self.latency.reset()
         self.init_redis()
 
     def init_redis(self):
         self._redis_client = self.get_redis_func()
+        self.sequencer = Sequencer(self._redis_client, self.config.get('sequence_history', HISTORY_SIZE))
+
+        # общий с session_keeper и get_bars лимит запросов к шлюзу
+        settings = get_rate_limit_settings(self.config)
+        if settings is not None:
+            self.rate_limiter = AsyncRateLimiter(
+                self._redis_client, self.config['username'], **settings
+            )
+
+    async def can_subscribe(self):
+        """
+        Переподписка не ждет токен: не дали сейчас — попробуем на следующем recv.
+        """
+        if not self.rate_limiter:
+            return True
+        return await self.rate_limiter.acquire(LIVE, timeout=0)
+
+    async def update_instruments(self):
+        """
+        Подписаться на новые инструменты и отписаться от удаленных,
+        не переоткрывая сокет.
+        """
+        added, removed = reload_instruments()
+
+        for instrument in removed:
+            conid = instrument["conid"]
+            cprint(f"отписываемся от {conid}", "yellow")
+            await self.send(f"umd+{conid}+" + '{}')
+            self._last_data_ts.pop(conid, None)
+            self.snapshots.remove(conid)
+            self.conflator.remove("{symbol}.{exchange}".format(**instrument))
+
+        if added or removed:
+            self.instruments_by_conid = {
+                i["conid"]: i for i in self.config['instruments']
+            }
+
+        for instrument in added:
+            conid = instrument["conid"]
+            cprint(f"подписываемся на {conid}", "green")
+            # если токена нет, подпишется позже как инструмент без данных
+            if not await self.can_subscribe():
+                continue
+            await self.send(f"smd+{conid}+{SMD_ARGS}")
+            self._last_data_ts[conid] = time.time()
+
+        # заодно досылаем smh, которые не пустил лимитер
+        await self.update_history_subscriptions()
 
     async def listen_messages(self):
         async for msg in self:
-            # питоновская магия
-            self._last_messages_ts = time.time()
+            # питоновская магия, всё делается в recv
+            pass
         cprint('сообщения внезапно закончились', 'red')
 
     ###
@@ -78,31 +175,51 @@ class IbkrWebsocketClient(WebSocketClientProtocol):
         price = json_data.get('31')
         conid = json_data.get("conid")
 
-        if not price or not conid:
-            # иногда приходит просто _updated
+        if not conid or conid not in self.instruments_by_conid:
+            # хвост данных по инструменту, от которого уже отписались
             return
 
         symbol = "{symbol}.{exchange}".format(**self.instruments_by_conid[conid])
+
+        # bid/ask тоже значат, что подписка живая
+        if self.snapshots.merge(conid, symbol, json_data):
+            self._last_data_ts[conid] = time.time()
+
+        if not price:
+            # иногда приходит просто _updated или только bid/ask
+            return
+
+        recv_ms = self._last_messages_ts * 1000
         updated = datetime.utcfromtimestamp(json_data["_updated"] / 1000)
         msg = {
             "dt": updated,
             "price": price,
             "conid": conid,
             "symbol": symbol,
+            # на сколько мс тик опоздал к нам с учетом расхождения часов;
+            # остальное до подписчика — задержка конвейера
+            "ingest_lag_ms": round(self.latency.observe(json_data["_updated"], recv_ms)),
         }
         self._last_data_ts[conid] = time.time()
         json_str = json.dumps(msg, indent=None, default=str)
-        await self._redis_client.publish(f"{symbol}:TRADES", json_str)
+        await self.sequencer.publish(f"{symbol}:TRADES", json_str)
+        self.latency.observe_pipeline(recv_ms, now_ms())
+        self.conflator.update(symbol, json_str)
+
+        if self.archive:
+            self.archive.append(symbol, json_data["_updated"], parse_number(price),
+                                parse_number(json_data.get("7059")))
 
     async def do_heartbeat(self, json_data):
-        # @TODO непонятно как считается параметр hb
-        hb_time_seconds = int(str(json_data.get('hb'))[:10])
-        diff_seconds = self.current_time_seconds - hb_time_seconds
-        if diff_seconds > 0:
-            cprint("heartbeat запаздывает на %d секунд" % diff_seconds, "red")
+        hb_ms = parse_server_ms(json_data.get('hb'))
+        lag = self.latency.observe(hb_ms, self._last_messages_ts * 1000)
+        if lag > 1000:
+            cprint("heartbeat запаздывает на %d мс" % lag, "red")
 
         if self.current_time_seconds - self._last_heartbeat_seconds >= 30:
             await self.send('ech+hb')
+            # ответ ech+hb дает RTT для оценки часов
+            self.latency.ping_sent(now_ms())
             self._last_heartbeat_seconds = int(time.time())
 
     async def do_handle_status(self, json_data):
@@ -112,6 +229,10 @@ class IbkrWebsocketClient(WebSocketClientProtocol):
         if authenticated is not None:
             if authenticated and not fail:
                 cprint("авторизовались!", "green")
+                if not self.authenticated and self.config.get('account_topics', False):
+                    await self.subscribe_account_topics()
+                if not self.authenticated:
+                    await self.update_history_subscriptions()
                 self.authenticated = True
             else:
                 cprint("не авторизовались :-( %s" % fail, "red")
@@ -120,6 +241,91 @@ class IbkrWebsocketClient(WebSocketClientProtocol):
 
         # @TODO тут как-то обрабатывать статусы и слать в телегу
 
+    async def update_history_subscriptions(self):
+        """
+        Подписки smh на минутные бары для инструментов из get_ws_bar_instruments.
+        """
+        wanted = {i["conid"] for i in get_ws_bar_instruments(self.config)}
+
+        for conid in [c for c in self._history_conids if c not in wanted]:
+            server_id = self._history_conids.pop(conid)
+            if server_id:
+                await self.send(f"umh+{server_id}")
+
+        for conid in wanted:
+            if conid in self._history_conids:
+                continue
+            if not await self.can_subscribe():
+                # остальные подпишутся при следующей проверке инструментов
+                break
+            await self.send(f"smh+{conid}+{SMH_ARGS}")
+            self._history_conids[conid] = None
+
+    async def do_parse_history(self, json_data):
+        conid = int(json_data["topic"].split("+")[1])
+        if conid not in self._history_conids or conid not in self.instruments_by_conid:
+            return
+
+        if json_data.get("serverId"):
+            self._history_conids[conid] = json_data["serverId"]
+
+        bars = json_data.get("data")
+        if not bars:
+            return
+
+        # пока пишутся прошлые бары, новые копятся и уходят одной пачкой
+        self._pending_bars.setdefault(conid, {}).update({b["t"]: b for b in bars})
+        if conid not in self._history_tasks:
+            self._history_tasks[conid] = asyncio.create_task(self.save_history(conid))
+
+    async def save_history(self, conid):
+        """
+        Писать окончательные бары, пока есть ожидающие. Незаконченные минуты
+        остаются в _pending_bars, и запись повторяется, когда они устоятся.
+        """
+        redis_client = get_redis_client(self.config)
+        try:
+            while pending := self._pending_bars.get(conid):
+                instrument = self.instruments_by_conid.get(conid)
+                if not instrument:
+                    self._pending_bars.pop(conid, None)
+                    return
+
+                ready = [t for t, bar in pending.items() if settle_delay(bar) <= 0]
+                if not ready:
+                    delay = min(settle_delay(bar) for bar in pending.values())
+                    await asyncio.sleep(max(delay, 0.1))
+                    continue
+
+                # обновления этих минут, пришедшие во время записи, запишутся следующим кругом
+                bars = [pending.pop(t) for t in ready]
+                # тот же разбор fix/late/empty, что в get_bars, синхронный
+                await asyncio.to_thread(merge_bars, instrument, bars, redis_client)
+        except Exception as e:
+            cprint("smh merge error %s" % get_traceback(e), "red")
+        finally:
+            self._history_tasks.pop(conid, None)
+
+    async def subscribe_account_topics(self):
+        # ордера, исполнения и P&L по всем аккаунтам сессии
+        for topic in ["sor", "str", "spl"]:
+            await self.send(topic + "+{}")
+
+    async def do_handle_orders(self, json_data):
+        args = json_data.get('args')
+        if isinstance(args, list):
+            self.account_state.update_orders(args)
+
+    async def do_handle_trades(self, json_data):
+        args = json_data.get('args')
+        if isinstance(args, list):
+            self.account_state.update_executions(args)
+
+    async def do_handle_pnl(self, json_data):
+        args = json_data.get('args')
+        if isinstance(args, dict):
+            self.account_state.update_pnl(args)
+
     async def do_handle_system(self, json_data):
         # @TODO
         # системные сообщения
@@ -142,8 +348,14 @@ class IbkrWebsocketClient(WebSocketClientProtocol):
 
     async def do_pong(self):
         # ответ на ech+hb
-        # @TODO что-то делать тут наверное
-        pass
+        self.latency.pong_received(now_ms())
+
+    async def publish_latency(self):
+        report = self.latency.report()
+        cprint("latency: %s" % report, "blue")
+        json_str = json.dumps(report, indent=None)
+        await self._redis_client.set(redis_key("TRADES:LATENCY"), json_str)
+        await self._redis_client.publish("TRADES:LATENCY", json_str)
 
     async def recv(self):
         """
@@ -152,6 +364,7 @@ class IbkrWebsocketClient(WebSocketClientProtocol):
         recv неявно дергается в listen_messages
         """
         data = await asyncio.wait_for(super().recv(), RECV_TIMEOUT)
+        self._last_messages_ts = time.time()
         cprint('recv: %s' % data, "yellow")
 
         self.current_time_seconds = int(time.time())
@@ -177,6 +390,8 @@ class IbkrWebsocketClient(WebSocketClientProtocol):
                 await self.do_auth()
             elif json_data.get("error"):
                 cprint("error: %s" % json_data, "red")
+                if self.rate_limiter and is_pacing_error(json_data):
+                    await self.rate_limiter.report_rejection()
                 await asyncio.sleep(5)
                 # пробуем реавторизоваться
                 await self.do_auth()
@@ -185,16 +400,14 @@ class IbkrWebsocketClient(WebSocketClientProtocol):
             elif topic.startswith('smd'):  # market data
                 await self.do_parse_market_data(json_data)
             elif topic.startswith('smh'):  # history data
-                # @TODO
-                pass
-            elif topic in ["sor", "uor"]:  # live orders
-                # @TODO
-                pass
-            elif topic in ["str", "utr"]:  # trades
-                # @TODO
-                pass
-            elif topic in ["spl", "upl"]:  # profit and loss
-                # @TODO
+                await self.do_parse_history(json_data)
+            elif topic == "sor":  # live orders
+                await self.do_handle_orders(json_data)
+            elif topic == "str":  # trades
+                await self.do_handle_trades(json_data)
+            elif topic == "spl":  # profit and loss
+                await self.do_handle_pnl(json_data)
+            elif topic in ["uor", "utr", "upl"] or topic.startswith("umh"):  # ответы на отписку
                 pass
             elif topic == 'sts':
                 await self.do_handle_status(json_data)
@@ -214,13 +427,20 @@ class IbkrWebsocketClient(WebSocketClientProtocol):
             cprint('пришло что-то новое и непонятное: %s' % text_data)
 
         if self.authenticated:
+            # не поменялся ли список инструментов
+            if self.current_time_seconds - self._last_instruments_check >= INSTRUMENTS_CHECK_SECONDS:
+                self._last_instruments_check = self.current_time_seconds
+                await self.update_instruments()
+
             # проверяем надо ли обновить подписку
             for instrument in self.config['instruments']:
                 conid = instrument["conid"]
                 last_data_ts = self._last_data_ts.get(conid, 0)
                 if time.time() - last_data_ts > 10:
                     # данных не было 10 секунд, пробуем подписаться заново
-                    cmd = f"smd+{conid}+" + '{"fields":["31"]}'
+                    if not await self.can_subscribe():
+                        break
+                    cmd = f"smd+{conid}+{SMD_ARGS}"
                     await self.send(cmd)
 
                     # чтобы не подписываться 800 раз пока не придет ответ
@@ -231,6 +451,13 @@ class IbkrWebsocketClient(WebSocketClientProtocol):
                 await self.send('tic')
                 self._last_tic_seconds = self.current_time_seconds
 
+        if self.current_time_seconds - self._last_latency_report >= REPORT_SECONDS:
+            self._last_latency_report = self.current_time_seconds
+            await self.publish_latency()
+
+        # фид стабильно отстает — переподключиться, не дожидаясь RECV_TIMEOUT
+        self.latency.check()
+
         return data
 
     async def send(self, message):
@@ -256,7 +483,49 @@ async def main(config_path):
     config = get_config(config_path)
     ib = get_ib_instance(config)
 
+    # снимки переживают переподключения сокета
+    snapshots = get_snapshot_store(config)
+    snapshots.start(
+        get_redis_func(config),
+        config.get('snapshot_flush_seconds', SNAPSHOT_FLUSH_SECONDS),
+    )
+
+    # прореженные каналы для медленных подписчиков
+    get_conflator(config).start(get_redis_func(config))
+
+    # живые бары по websocket, разбираются по расписаниям бирж как в get_bars
+    if get_ws_bar_instruments(config):
+        base_dir = abspath(dirname(__file__))
+        set_cache_dir(abspath(join(base_dir, config.get('calendar_cache_dir', 'cache'))))
+
+    # архив тиков пишется на диск в отдельном потоке
+    if archive := get_tick_archive(config):
+        archive.start(
+            config.get('tick_archive_flush_seconds', FLUSH_SECONDS),
+            config.get('tick_archive_fsync_seconds', FSYNC_SECONDS),
+        )
+
+    # supervisor останавливает по TERM: выходим так же, как по Ctrl+C,
+    # чтобы дописать архив тиков
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
     ws = await get_ws_client(ib, config)
+    startup_report("get_trades_async")
+
+    try:
+        await listen_forever(ws, ib, config)
+    except asyncio.CancelledError:
+        cprint("остановка", "yellow")
+    finally:
+        if archive:
+            archive.close()
+
+
+async def listen_forever(ws, ib, config):
+    """
+    Слушать сокет, переподключаясь при ошибках, пока задачу не отменят.
+    """
+    import aioredis
 
     counter = 0
     while True:
@@ -277,9 +546,10 @@ async def main(config_path):
             cprint('redis error', 'red')
             await asyncio.sleep(3)
             ws.init_redis()
-        except asyncio.exceptions.TimeoutError:
-            # сообщений не было дольше RECV_TIMEOUT секунд, переоткрываем сокет
-            cprint('timeout', "red")
+        except (asyncio.exceptions.TimeoutError, FeedLagError) as e:
+            # сообщений не было дольше RECV_TIMEOUT секунд
+            # или они приходят с большой задержкой, переоткрываем сокет
+            cprint('timeout %s' % e, "red")
             await ws.force_close()  # не бросает исключений
             ws = await get_ws_client(ib, config)
         except Exception as e:
@@ -301,4 +571,9 @@ async def get_ws_client(ib, config):
 
     return ws
 
-asyncio.get_event_loop().run_until_complete(main())
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("DONE")
@@ -0,0 +1,169 @@
+"""
+Оценка задержки фида IBKR и расхождения часов.
+
+Время сервера берется из hb и _updated, локальное — момент recv, всё в мс.
+Смещение часов (skew) оценивается как в NTP: минимум (локальное - серверное)
+за окно минус половина минимального RTT (ech+hb туда и обратно).
+Задержка фида = локальное - серверное - skew, то есть насколько поздно
+данные дошли до нашего сокета. Всё, что дольше — задержка нашего конвейера.
+
+Если медиана последних задержек фида выше max_feed_lag_ms, клиент
+переподключается, не дожидаясь RECV_TIMEOUT.
+"""
+import time
+from collections import deque
+
+# сколько последних замеров держать для перцентилей
+WINDOW = 1000
+
+# за сколько секунд держать замеры смещения для оценки skew
+SKEW_WINDOW_SECONDS = 600
+
+# по стольким последним замерам решаем, что фид отстает
+RECONNECT_SAMPLES = 10
+MAX_FEED_LAG_MS = 5000
+
+# как часто публиковать метрики
+REPORT_SECONDS = 10
+
+_estimator = None
+
+
+class FeedLagError(Exception):
+    pass
+
+
+def now_ms():
+    return time.time() * 1000
+
+
+def parse_server_ms(value):
+    """
+    hb и _updated приходят в мс, но на всякий случай понимаем и секунды.
+    """
+    value = int(value)
+    if value < 10 ** 11:
+        value *= 1000
+    return value
+
+
+class RollingPercentiles:
+    def __init__(self, window=WINDOW):
+        self.samples = deque(maxlen=window)
+
+    def add(self, value):
+        self.samples.append(value)
+
+    def percentile(self, q):
+        if not self.samples:
+            return None
+        data = sorted(self.samples)
+        return data[min(len(data) - 1, int(q / 100 * len(data)))]
+
+    def report(self):
+        result = {}
+        for q in (50, 90, 99):
+            value = self.percentile(q)
+            result[f"p{q}"] = None if value is None else round(value, 1)
+        return result
+
+
+class LatencyEstimator:
+    def __init__(self, max_feed_lag_ms=MAX_FEED_LAG_MS):
+        self.max_feed_lag_ms = max_feed_lag_ms
+        self.feed_lag = RollingPercentiles()
+        self.pipeline_lag = RollingPercentiles()
+        self.rtt = RollingPercentiles()
+
+        # (локальное мс, локальное - серверное) по возрастанию смещения,
+        # минимум за окно всегда первый
+        self._offsets = deque()
+        self._min_rtt = None
+        self._ping_sent_ms = None
+        self._recent = deque(maxlen=RECONNECT_SAMPLES)
+
+    @property
+    def skew_ms(self):
+        """
+        На сколько мс наши часы впереди сервера, None пока нет замеров.
+        """
+        if not self._offsets:
+            return None
+        skew = self._offsets[0][1]
+        if self._min_rtt is not None:
+            skew -= self._min_rtt / 2
+        return skew
+
+    def _add_offset(self, local_ms, server_ms):
+        offset = local_ms - server_ms
+        # замеры, которые больше нового, уже никогда не станут минимумом
+        while self._offsets and self._offsets[-1][1] >= offset:
+            self._offsets.pop()
+        self._offsets.append((local_ms, offset))
+        while self._offsets[0][0] < local_ms - SKEW_WINDOW_SECONDS * 1000:
+            self._offsets.popleft()
+
+    def observe(self, server_ms, local_ms):
+        """
+        Замер по hb или _updated, возвращает задержку фида в мс.
+        """
+        self._add_offset(local_ms, server_ms)
+        lag = max(0.0, local_ms - server_ms - self.skew_ms)
+        self.feed_lag.add(lag)
+        self._recent.append(lag)
+        return lag
+
+    def ping_sent(self, local_ms):
+        self._ping_sent_ms = local_ms
+
+    def pong_received(self, local_ms):
+        if self._ping_sent_ms is None:
+            return
+        rtt = local_ms - self._ping_sent_ms
+        self._ping_sent_ms = None
+        self.rtt.add(rtt)
+        if self._min_rtt is None or rtt < self._min_rtt:
+            self._min_rtt = rtt
+
+    def observe_pipeline(self, recv_ms, local_ms):
+        self.pipeline_lag.add(local_ms - recv_ms)
+
+    def check(self):
+        """
+        FeedLagError, если фид стабильно отстает больше порога.
+        """
+        if len(self._recent) < RECONNECT_SAMPLES:
+            return
+        median = sorted(self._recent)[len(self._recent) // 2]
+        if median > self.max_feed_lag_ms:
+            self._recent.clear()
+            raise FeedLagError(f"feed lag {median:.0f}ms > {self.max_feed_lag_ms}ms")
+
+    def reset(self):
+        """
+        После переподключения старые задержки уже ничего не значат,
+        а оценка часов остается.
+        """
+        self._recent.clear()
+        self._ping_sent_ms = None
+
+    def report(self):
+        skew = self.skew_ms
+        return {
+            "skew_ms": None if skew is None else round(skew, 1),
+            "feed_lag_ms": self.feed_lag.report(),
+            "pipeline_lag_ms": self.pipeline_lag.report(),
+            "rtt_ms": self.rtt.report(),
+        }
+
+
+def get_latency_estimator(config):
+    """
+    Один на процесс, чтобы оценка часов переживала переподключения.
+    """
+    global _estimator
+
+    if not _estimator:
+        _estimator = LatencyEstimator(config.get('max_feed_lag_ms', MAX_FEED_LAG_MS))
+
+    return _estimator
@@ -0,0 +1,132 @@
+"""
+Замеры времени по стадиям и семплирующий профайлер для медленных итераций.
+
+Профайлер включается переменной окружения TRADIS_PROFILE=1
+или сигналом SIGUSR1 (повторный сигнал выключает).
+Стеки сохраняются в формате folded (flamegraph.pl, speedscope)
+только для итераций дольше TRADIS_PROFILE_SLOW_SECONDS.
+"""
+import os
+import signal
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from os.path import join
+from time import perf_counter
+
+from termcolor import cprint
+
+
+class StageTimer:
+    """
+    Суммарное время и количество вызовов по стадиям одной итерации.
+    Стадии можно вкладывать друг в друга, время считается для каждой.
+    """
+    def __init__(self):
+        self.totals = Counter()
+        self.counts = Counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - started
+            with self._lock:
+                self.totals[name] += elapsed
+                self.counts[name] += 1
+
+    def reset(self):
+        with self._lock:
+            self.totals.clear()
+            self.counts.clear()
+
+    def report(self):
+        with self._lock:
+            lines = [
+                f"{name:>14}: {total * 1000:9.1f} ms  x{self.counts[name]}"
+                for name, total in self.totals.most_common()
+            ]
+        return "\n".join(lines)
+
+
+class SamplingProfiler:
+    """
+    Раз в interval секунд (по wall clock, чтобы видеть и ожидание сети)
+    снимает стеки всех потоков и копит их в Counter.
+    """
+    def __init__(self, enabled=False, interval=0.005, slow_seconds=30, output_dir="."):
+        self.enabled = enabled
+        self.interval = interval
+        self.slow_seconds = slow_seconds
+        self.output_dir = output_dir
+        self.stacks = Counter()
+        self._running = False
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            enabled=os.environ.get("TRADIS_PROFILE") == "1",
+            interval=float(os.environ.get("TRADIS_PROFILE_INTERVAL", 0.005)),
+            slow_seconds=float(os.environ.get("TRADIS_PROFILE_SLOW_SECONDS", 30)),
+            output_dir=os.environ.get("TRADIS_PROFILE_DIR", "."),
+        )
+
+    def install_toggle(self, signum=signal.SIGUSR1):
+        signal.signal(signum, self._toggle)
+
+    def _toggle(self, signum, frame):
+        self.enabled = not self.enabled
+        cprint(f"PROFILER {'ON' if self.enabled else 'OFF'}", "magenta")
+
+    def _sample(self, signum, frame):
+        frames = sys._current_frames()
+        # для текущего потока берем прерванный фрейм, без самого обработчика
+        frames[threading.get_ident()] = frame
+        for thread_frame in frames.values():
+            stack = []
+            f = thread_frame
+            while f is not None:
+                code = f.f_code
+                stack.append(f"{code.co_name} ({code.co_filename}:{f.f_lineno})")
+                f = f.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def start_iteration(self):
+        self.stacks.clear()
+        if not self.enabled:
+            return
+        signal.signal(signal.SIGALRM, self._sample)
+        signal.setitimer(signal.ITIMER_REAL, self.interval, self.interval)
+        self._running = True
+
+    def finish_iteration(self, duration, name="iteration"):
+        """
+        Остановить семплирование и сохранить стеки, если итерация была медленной.
+        Возвращает путь к файлу или None.
+        """
+        if not self._running:
+            return None
+
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        self._running = False
+
+        if duration < self.slow_seconds or not self.stacks:
+            return None
+
+        ts = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+        path = join(self.output_dir, f"{name}-{ts}.folded")
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        cprint(f"Медленная итерация {duration:.1f}s, стеки в {path}", "magenta")
+        return path
+
+
+timer = StageTimer()
+stage = timer.stage
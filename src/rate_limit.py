@@ -0,0 +1,185 @@
+"""
+Общий на все демоны token bucket перед запросами в IBKR.
+
+Состояние лежит в Redis hash ratelimit:{session}, токены списываются
+Lua-скриптом атомарно, так что session_keeper, get_bars и get_trades_async
+делят один лимит шлюза.
+
+Приоритеты: запрос младшего класса проходит, только если после него
+в ведре останется резерв для старших (доля емкости из PRIORITY_RESERVE).
+На ответ о превышении лимита скорость ведра уменьшается вдвое
+и потом линейно восстанавливается до базовой.
+"""
+import asyncio
+import time
+
+from termcolor import cprint
+
+from config import redis_key
+
+KEEPALIVE = "keepalive"
+LIVE = "live"
+BACKFILL = "backfill"
+
+# доля емкости, которая должна остаться после запроса
+PRIORITY_RESERVE = {
+    KEEPALIVE: 0.0,
+    LIVE: 0.2,
+    BACKFILL: 0.5,
+}
+
+# лимит web API IBKR порядка 10 запросов в секунду
+DEFAULT_RATE = 8
+DEFAULT_CAPACITY = 10
+
+# ниже этой доли от базовой скорость не опускается
+MIN_RATE_FRACTION = 0.1
+
+# за сколько секунд скорость восстанавливается от нуля до базовой
+RECOVERY_SECONDS = 60
+
+# где в ответе IBKR искать HTTP статус и текст ошибки
+PACING_STATUS_FIELDS = ("status_code", "statusCode", "status")
+PACING_MESSAGE_FIELDS = ("error", "_ERROR", "message", "text")
+
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local base_rate = tonumber(ARGV[3])
+local reserve = tonumber(ARGV[4])
+local cost = tonumber(ARGV[5])
+local recovery = tonumber(ARGV[6])
+
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'rate')
+local tokens = tonumber(data[1]) or capacity
+local ts = tonumber(data[2]) or now
+local rate = tonumber(data[3]) or base_rate
+
+local elapsed = math.max(0, now - ts) / 1000
+rate = math.min(base_rate, rate + base_rate * elapsed / recovery)
+tokens = math.min(capacity, tokens + elapsed * rate)
+
+local allowed = 0
+local wait = 0
+if tokens - cost >= reserve then
+    tokens = tokens - cost
+    allowed = 1
+else
+    wait = math.ceil((reserve + cost - tokens) / rate * 1000)
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now, 'rate', tostring(rate))
+redis.call('PEXPIRE', KEYS[1], 600000)
+return {allowed, wait}
+"""
+
+REJECT_SCRIPT = """
+local base_rate = tonumber(ARGV[1])
+local min_rate = tonumber(ARGV[2])
+local rate = tonumber(redis.call('HGET', KEYS[1], 'rate')) or base_rate
+rate = math.max(min_rate, rate / 2)
+redis.call('HSET', KEYS[1], 'rate', tostring(rate), 'tokens', '0')
+return tostring(rate)
+"""
+
+
+def get_rate_limit_settings(config):
+    """
+    Параметры из config['rate_limit'] или None, если лимитер выключен
+    (rate_limit: false).
+    """
+    settings = config.get('rate_limit', {})
+    if settings is False:
+        return None
+    return {
+        "rate": (settings or {}).get("rate", DEFAULT_RATE),
+        "capacity": (settings or {}).get("capacity", DEFAULT_CAPACITY),
+    }
+
+
+def is_pacing_error(response):
+    """
+    Похоже ли на отказ IBKR из-за частоты запросов.
+    """
+    if not isinstance(response, dict):
+        return False
+    if not (response.get("_ERROR") or response.get("error")):
+        return False
+    for field in PACING_STATUS_FIELDS:
+        if str(response.get(field)) == "429":
+            return True
+    # только текст ошибки: в теле ответа "429" бывает и в conid, и в цене
+    for field in PACING_MESSAGE_FIELDS:
+        text = response.get(field)
+        if isinstance(text, str) and ("pacing" in text.lower() or "too many" in text.lower()):
+            return True
+    return False
+
+
+class RateLimiter:
+    def __init__(self, redis_client, session, rate=DEFAULT_RATE, capacity=DEFAULT_CAPACITY):
+        self.key = redis_key(f"ratelimit:{session}")
+        self.rate = rate
+        self.capacity = capacity
+        self._acquire = redis_client.register_script(ACQUIRE_SCRIPT)
+        self._reject = redis_client.register_script(REJECT_SCRIPT)
+
+    def _acquire_args(self, priority):
+        return [
+            int(time.time() * 1000),
+            self.capacity,
+            self.rate,
+            PRIORITY_RESERVE[priority] * self.capacity,
+            1,
+            RECOVERY_SECONDS,
+        ]
+
+    def acquire(self, priority=LIVE, timeout=10):
+        """
+        Дождаться токена. False, если не дождались за timeout секунд.
+        Если Redis недоступен — пропускаем, торговлю это не должно останавливать.
+        """
+        deadline = time.time() + timeout
+        while True:
+            try:
+                allowed, wait_ms = self._acquire(keys=[self.key], args=self._acquire_args(priority))
+            except Exception as e:
+                cprint(f"rate limiter error {e}", "red")
+                return True
+            if allowed:
+                return True
+            if time.time() + wait_ms / 1000 > deadline:
+                return False
+            time.sleep(wait_ms / 1000)
+
+    def report_rejection(self):
+        try:
+            rate = self._reject(keys=[self.key], args=[self.rate, self.rate * MIN_RATE_FRACTION])
+            cprint(f"IBKR pacing, скорость снижена до {float(rate):.2f}/s", "red")
+        except Exception as e:
+            cprint(f"rate limiter error {e}", "red")
+
+
+class AsyncRateLimiter(RateLimiter):
+    async def acquire(self, priority=LIVE, timeout=10):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                allowed, wait_ms = await self._acquire(
+                    keys=[self.key], args=self._acquire_args(priority)
+                )
+            except Exception as e:
+                cprint(f"rate limiter error {e}", "red")
+                return True
+            if allowed:
+                return True
+            if time.time() + wait_ms / 1000 > deadline:
+                return False
+            await asyncio.sleep(wait_ms / 1000)
+
+    async def report_rejection(self):
+        try:
+            rate = await self._reject(keys=[self.key], args=[self.rate, self.rate * MIN_RATE_FRACTION])
+            cprint(f"IBKR pacing, скорость снижена до {float(rate):.2f}/s", "red")
+        except Exception as e:
+            cprint(f"rate limiter error {e}", "red")
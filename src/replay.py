@@ -0,0 +1,188 @@
+"""
+Проигрывание сохраненных баров и тиков в каналы Redis.
+
+Бары берутся из {symbol}.{exchange}:TRADES, тики — из архива тиков.
+Все инструменты сливаются в один поток по времени (heapq.merge) и публикуются
+в {prefix}{symbol}:BARS и {prefix}{symbol}:TRADES в тех же форматах, что
+replace_data и do_parse_market_data, со скоростью 1x, Nx или максимально
+возможной. Номера seq свои у каждого канала с префиксом (своя история),
+ingest_lag_ms в проигранных тиках нет — задержку старых данных не измерить.
+
+По умолчанию префикс replay:, в живые каналы — только с --live.
+
+    python replay.py config_local.yaml --start "2022-03-01 14:30" --end "2022-03-01 21:00" --speed 10
+    python replay.py config_local.yaml --start 2022-03-01 --end 2022-03-02 --speed 0 --live
+"""
+import heapq
+import json
+import time
+from datetime import datetime
+
+import click
+import orjson
+from termcolor import cprint
+
+from bars import dt_to_ts, get_key
+from config import get_config, get_redis_client
+from sequence import HISTORY_SIZE, Sequencer
+from tick_archive import read_range
+
+# сколько секунд баров читать из Redis за один запрос
+BARS_CHUNK_SECONDS = 24 * 3600
+
+# как часто печатать скорость
+REPORT_EVERY_SECONDS = 5
+
+DEFAULT_PREFIX = "replay:"
+
+
+def get_symbol(instrument):
+    return "{symbol}.{exchange}".format(**instrument)
+
+
+def dumps(data):
+    return json.dumps(data, indent=None, separators=(',', ':'), default=str)
+
+
+def iter_bars(instrument, start_ts, end_ts, redis_client):
+    """
+    (время публикации, канал, сообщение) для баров инструмента.
+    Бар минуты публикуется, когда минута закончилась.
+    """
+    key = get_key(instrument)
+    symbol = get_symbol(instrument)
+    chunk_start = start_ts
+    while chunk_start <= end_ts:
+        chunk_end = min(end_ts, chunk_start + BARS_CHUNK_SECONDS - 1)
+        rows = redis_client.zrangebyscore(key, chunk_start, chunk_end, withscores=True)
+        for line, score in rows:
+            bar = orjson.loads(line)
+            bar["conid"] = instrument["conid"]
+            bar["symbol"] = symbol
+            yield int(score) + 60, f"{symbol}:BARS", dumps(bar)
+        chunk_start = chunk_end + 1
+
+
+def iter_ticks(instrument, start_ts, end_ts, archive_dir):
+    symbol = get_symbol(instrument)
+    ticks = read_range(archive_dir, symbol, start_ts * 1000, end_ts * 1000)
+    for ts, price, _ in ticks.tolist():
+        msg = {
+            "dt": datetime.utcfromtimestamp(ts / 1000),
+            "price": str(price),
+            "conid": instrument["conid"],
+            "symbol": symbol,
+        }
+        yield ts / 1000, f"{symbol}:TRADES", dumps(msg)
+
+
+def replay(streams, redis_client, speed, batch_size, prefix=DEFAULT_PREFIX, history_size=HISTORY_SIZE):
+    """
+    Опубликовать слитый по времени поток.
+    speed: 1 — реальное время, N — в N раз быстрее, 0 — без пауз.
+    """
+    merged = heapq.merge(*streams, key=lambda event: event[0])
+
+    started = time.perf_counter()
+    first_ts = None
+    sent = 0
+    last_report = started
+    last_report_sent = 0
+
+    pipe = redis_client.pipeline(transaction=False)
+    # seq и история, как у живых каналов, но для каналов с префиксом
+    sequencer = Sequencer(pipe, history_size)
+    pending = 0
+
+    for ts, channel, message in merged:
+        if first_ts is None:
+            first_ts = ts
+
+        if speed:
+            due = started + (ts - first_ts) / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                # отдать накопленное, пока ждем
+                if pending:
+                    pipe.execute()
+                    sent += pending
+                    pending = 0
+                time.sleep(delay)
+
+        sequencer.publish(prefix + channel, message)
+        pending += 1
+        if pending >= batch_size:
+            pipe.execute()
+            sent += pending
+            pending = 0
+
+        now = time.perf_counter()
+        if now - last_report >= REPORT_EVERY_SECONDS:
+            rate = (sent - last_report_sent) / (now - last_report)
+            cprint(f"{datetime.utcfromtimestamp(ts)}  {sent} msg  {rate:.0f} msg/s", "white")
+            last_report, last_report_sent = now, sent
+
+    if pending:
+        pipe.execute()
+        sent += pending
+
+    elapsed = time.perf_counter() - started
+    return sent, elapsed
+
+
+def parse_dt(value):
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise click.BadParameter(f"не понимаю дату {value}")
+
+
+@click.command()
+@click.argument('config_path', type=click.Path(exists=True))
+@click.option('--start', required=True, help="Начало, UTC")
+@click.option('--end', default=None, help="Конец, UTC (по умолчанию сейчас)")
+@click.option('--speed', default=1.0, help="Множитель скорости, 0 — максимальная")
+@click.option('--symbols', default=None, help="Через запятую, например AAPL.NASDAQ,MES.GLOBEX")
+@click.option('--bars/--no-bars', default=True)
+@click.option('--ticks/--no-ticks', default=True)
+@click.option('--batch', default=500, help="Сообщений в одном pipeline")
+@click.option('--prefix', default=DEFAULT_PREFIX, help="Префикс каналов, чтобы не мешать живым данным")
+@click.option('--live', is_flag=True, help="Публиковать в живые каналы, без префикса")
+def main(config_path, start, end, speed, symbols, bars, ticks, batch, prefix, live):
+    if live:
+        prefix = ""
+    elif not prefix:
+        raise click.BadParameter("пустой префикс — это живые каналы, для них есть --live")
+
+    config = get_config(config_path)
+    redis_client = get_redis_client(config)
+
+    start_ts = dt_to_ts(parse_dt(start))
+    end_ts = dt_to_ts(parse_dt(end) if end else datetime.utcnow())
+
+    instruments = config['instruments']
+    if symbols:
+        wanted = set(symbols.split(","))
+        instruments = [i for i in instruments if get_symbol(i) in wanted]
+
+    streams = []
+    for instrument in instruments:
+        if bars:
+            streams.append(iter_bars(instrument, start_ts, end_ts, redis_client))
+        if ticks and config.get('tick_archive_dir'):
+            streams.append(iter_ticks(instrument, start_ts, end_ts, config['tick_archive_dir']))
+
+    cprint(f"REPLAY {len(instruments)} инструментов, x{speed or 'max'}", "green")
+    history_size = config.get('sequence_history', HISTORY_SIZE)
+    sent, elapsed = replay(streams, redis_client, speed, batch, prefix, history_size)
+    rate = sent / elapsed if elapsed else 0
+    cprint(f"DONE {sent} сообщений за {elapsed:.1f}s, {rate:.0f} msg/s", "green")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("DONE")
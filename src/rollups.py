@@ -0,0 +1,187 @@
+"""
+Бары старших таймфреймов, собранные из минутных.
+
+Каждый таймфрейм собирается из предыдущего (5m из 1m, 15m из 5m и т.д.),
+поэтому пересчет одного бакета читает несколько строк, а не тысячи минут.
+При исправлении старой минуты пересчитываются только ее родительские бакеты,
+и выше по цепочке идем, только если бакет действительно изменился.
+
+Дневной бакет — сутки по UTC. Когда дневного бакета еще нет (первое касание
+дня после запуска), все таймфреймы за сутки собираются заново из минут,
+иначе старшие бакеты собрались бы только из минут, пришедших после запуска.
+Старые данные пересобираются командой:
+
+    python rollups.py config_local.yaml --days 30
+"""
+import json
+from datetime import datetime, timedelta, timezone
+
+import click
+import orjson
+from termcolor import cprint
+
+from config import get_config, get_redis_client, redis_key
+
+# (название, длина в секундах, из какого таймфрейма собирается)
+TIMEFRAMES = [
+    ("5m", 300, None),
+    ("15m", 900, "5m"),
+    ("1h", 3600, "15m"),
+    ("1d", 86400, "1h"),
+]
+
+# (ключ дневных бакетов, сутки), которые уже собраны из минут целиком
+_seeded = set()
+SEEDED_MAX = 100_000
+
+
+def get_rollup_key(instrument, timeframe=None):
+    key = "{symbol}.{exchange}:TRADES".format(**instrument)
+    return redis_key(f"{key}:{timeframe}" if timeframe else key)
+
+
+def get_rollup_channel(instrument, timeframe):
+    return "{symbol}.{exchange}:BARS:{tf}".format(tf=timeframe, **instrument)
+
+
+def has_price(line):
+    return bool(line) and "o" in line
+
+
+def aggregate(lines, bucket_dt):
+    """
+    Свернуть строки младшего таймфрейма (уже по порядку) в один бар.
+    Строки без цены (closed, empty, error) пропускаются.
+    """
+    bars = [line for line in lines if has_price(line)]
+    if not bars:
+        return None
+
+    return {
+        "dt": bucket_dt,
+        "o": bars[0]["o"],
+        "h": max(bar["h"] for bar in bars),
+        "l": min(bar["l"] for bar in bars),
+        "c": bars[-1]["c"],
+        "vol": sum(bar.get("vol") or 0 for bar in bars),
+        "cnt": sum(bar.get("cnt", 1) for bar in bars),
+    }
+
+
+def dumps(line):
+    return json.dumps(line, indent=None, separators=(',', ':'), default=str)
+
+
+def get_seed_days(instrument, minutes, redis_client):
+    """
+    Сутки, в которых дневного бакета еще нет: их надо собрать целиком.
+    """
+    day_timeframe, day_seconds, _ = TIMEFRAMES[-1]
+    key = get_rollup_key(instrument, day_timeframe)
+    days = {ts - ts % day_seconds for ts in minutes}
+    days = sorted(day for day in days if (key, day) not in _seeded)
+    if not days:
+        return []
+
+    pipe = redis_client.pipeline(transaction=False)
+    for day in days:
+        pipe.zcount(key, day, day)
+    counts = pipe.execute()
+
+    if len(_seeded) > SEEDED_MAX:
+        _seeded.clear()
+    _seeded.update((key, day) for day in days)
+    return [day for day, count in zip(days, counts) if not count]
+
+
+def update_rollups(instrument, minutes, redis_client, seed_days=None):
+    """
+    Пересчитать бакеты всех таймфреймов, в которые попадают минуты minutes
+    (unix-секунды начала минуты). Возвращает количество измененных бакетов.
+    seed_days — сутки, которые собрать заново целиком, по умолчанию те,
+    где дневного бакета еще нет.
+    """
+    if seed_days is None:
+        seed_days = get_seed_days(instrument, minutes, redis_client)
+    day_seconds = TIMEFRAMES[-1][1]
+
+    touched = set(minutes)
+    changed_total = 0
+
+    for timeframe, seconds, child in TIMEFRAMES:
+        seeded = {
+            bucket
+            for day in seed_days
+            for bucket in range(day, day + day_seconds, seconds)
+        }
+        if not touched and not seeded:
+            break
+
+        key = get_rollup_key(instrument, timeframe)
+        child_key = get_rollup_key(instrument, child)
+        buckets = sorted({ts - ts % seconds for ts in touched} | seeded)
+
+        pipe = redis_client.pipeline(transaction=False)
+        for bucket in buckets:
+            pipe.zrangebyscore(child_key, bucket, bucket + seconds - 1)
+            pipe.zrangebyscore(key, bucket, bucket)
+        results = pipe.execute()
+
+        pipe = redis_client.pipeline(transaction=False)
+        changed = set()
+        for n, bucket in enumerate(buckets):
+            child_lines = [orjson.loads(line) for line in results[2 * n]]
+            old = [orjson.loads(line) for line in results[2 * n + 1]]
+            old = old[0] if old else None
+
+            bucket_dt = datetime.utcfromtimestamp(bucket).strftime("%Y-%m-%d %H:%M:%S")
+            new = aggregate(child_lines, bucket_dt)
+            if new == old:
+                continue
+
+            changed.add(bucket)
+            pipe.zremrangebyscore(key, bucket, bucket)
+            if new:
+                pipe.zadd(key, {dumps(new): bucket})
+                message = dict(new, conid=instrument["conid"],
+                               symbol="{symbol}.{exchange}".format(**instrument),
+                               tf=timeframe)
+            else:
+                # в бакете не осталось цен, подписчики должны об этом узнать
+                message = dict(dt=bucket_dt, deleted=1, conid=instrument["conid"],
+                               symbol="{symbol}.{exchange}".format(**instrument),
+                               tf=timeframe)
+            pipe.publish(get_rollup_channel(instrument, timeframe), dumps(message))
+
+        if changed:
+            pipe.execute()
+
+        changed_total += len(changed)
+        touched = changed
+
+    return changed_total
+
+
+@click.command()
+@click.argument('config_path', type=click.Path(exists=True))
+@click.option('--days', default=7, help="За сколько последних суток пересобрать")
+def main(config_path, days):
+    """
+    Пересобрать старшие таймфреймы из минут за последние days суток.
+    """
+    config = get_config(config_path)
+    redis_client = get_redis_client(config)
+
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    seed_days = [
+        int((today - timedelta(days=n)).replace(tzinfo=timezone.utc).timestamp())
+        for n in reversed(range(days))
+    ]
+
+    for instrument in config['instruments']:
+        changed = update_rollups(instrument, [], redis_client, seed_days=seed_days)
+        cprint(f"{get_rollup_key(instrument)}: {changed} бакетов", "green")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Номера сообщений в каналах {symbol}:TRADES и {symbol}:BARS.
+
+Публикация идет Lua-скриптом: он берет следующий номер канала, дописывает
+в сообщение поле "seq", кладет его в ограниченную историю (sorted set
+{channel}:HISTORY, score = seq) и публикует — всё атомарно, поэтому номера
+монотонны, даже если в канал пишут несколько процессов (бары пишут и get_bars,
+и get_trades_async).
+
+Подписчик, заметивший дырку в seq, дочитывает ровно пропущенное:
+
+    messages, complete = get_missing(redis_client, "AAPL.NASDAQ:TRADES", 1041, 1057)
+
+complete=False — часть уже вытеснена из истории, остальное придется
+перечитать из основных ключей.
+"""
+import orjson
+
+from config import get_config, redis_key
+
+# сколько последних сообщений канала хранить
+HISTORY_SIZE = 1000
+
+PUBLISH_SCRIPT = """
+local last = redis.call('ZREVRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+local seq = 1
+if last[2] then
+    seq = tonumber(last[2]) + 1
+end
+local message = string.sub(ARGV[2], 1, -2) .. ',"seq":' .. seq .. '}'
+redis.call('ZADD', KEYS[1], seq, message)
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -(tonumber(ARGV[3]) + 1))
+redis.call('PUBLISH', ARGV[1], message)
+return seq
+"""
+
+_sequencers = {}
+
+
+def get_history_key(channel):
+    return redis_key(f"{channel}:HISTORY")
+
+
+class Sequencer:
+    """
+    Работает и с redis, и с aioredis клиентом: для aioredis publish
+    возвращает корутину.
+    """
+    def __init__(self, redis_client, history_size=HISTORY_SIZE):
+        self.redis_client = redis_client
+        self.history_size = history_size
+        self._publish = None
+        if hasattr(redis_client, "register_script"):
+            self._publish = redis_client.register_script(PUBLISH_SCRIPT)
+
+    def publish(self, channel, message):
+        if self._publish is None:
+            # без Lua (RedisCluster в redis-py 4.1, фейки) — как раньше, без seq
+            return self.redis_client.publish(channel, message)
+        return self._publish(
+            keys=[get_history_key(channel)],
+            args=[channel, message, self.history_size],
+        )
+
+
+def get_sequencer(redis_client):
+    """
+    Sequencer для клиента, чтобы не регистрировать скрипт на каждую публикацию.
+    """
+    sequencer = _sequencers.get(id(redis_client))
+    if not sequencer or sequencer.redis_client is not redis_client:
+        history_size = get_config().get('sequence_history', HISTORY_SIZE)
+        sequencer = _sequencers[id(redis_client)] = Sequencer(redis_client, history_size)
+    return sequencer
+
+
+def _result(rows, after_seq, until_seq):
+    messages = [line for line, _ in rows]
+    if rows:
+        complete = int(rows[0][1]) == after_seq + 1
+    else:
+        # пусто: либо пропускать нечего, либо всё уже вытеснено
+        complete = until_seq is None or until_seq <= after_seq
+    return messages, complete
+
+
+def get_missing(redis_client, channel, after_seq, until_seq=None):
+    """
+    Сообщения канала с after_seq < seq <= until_seq (до конца, если None)
+    и полностью ли они нашлись в истории.
+    """
+    rows = redis_client.zrangebyscore(
+        get_history_key(channel), f"({after_seq}",
+        "+inf" if until_seq is None else until_seq, withscores=True,
+    )
+    return _result(rows, after_seq, until_seq)
+
+
+async def get_missing_async(redis_client, channel, after_seq, until_seq=None):
+    rows = await redis_client.zrangebyscore(
+        get_history_key(channel), f"({after_seq}",
+        "+inf" if until_seq is None else until_seq, withscores=True,
+    )
+    return _result(rows, after_seq, until_seq)
+
+
+class SequenceTracker:
+    """
+    Для подписчиков: помнит последний seq по каналам и говорит,
+    какой диапазон пропущен.
+    """
+    def __init__(self):
+        self.last_seq = {}
+
+    def check(self, channel, message):
+        """
+        (after_seq, until_seq) для get_missing или None, если дырки нет.
+        """
+        seq = orjson.loads(message).get("seq")
+        if seq is None:
+            return None
+
+        last = self.last_seq.get(channel)
+        self.last_seq[channel] = seq
+        if last is not None and last < seq - 1:
+            return last, seq - 1
+        return None
@@ -1,63 +1,178 @@
-from time import sleep
+"""
+Поддержание живых сессий IBKR для всех аккаунтов из конфига в одном процессе.
+
+У каждого аккаунта своя корутина со своим расписанием (с джиттером, чтобы
+аккаунты не опрашивали шлюз одновременно) и своей паузой между перелогинами.
+IbApi синхронный, его запросы выполняются в потоках.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from random import uniform
 
 import click
 from termcolor import cprint
-from config import get_config, get_ib_instance
+from config import get_accounts, get_config, new_ib_instance, new_rate_limiter
+from rate_limit import KEEPALIVE, is_pacing_error
+from utils import coro, get_traceback, startup_report
 
+# Поддержание сессии важнее всего остального, ждем токен подольше
+RATE_LIMIT_TIMEOUT = 30
 
-@click.command()
-@click.argument('config_path', type=click.Path(exists=True))
-def main(config_path):
-    config = get_config(config_path)
-    ib = get_ib_instance(config)
-    ib.load_session()
+# Как часто проверять сессию и слать tickle, секунд
+KEEPALIVE_SECONDS = 1
+KEEPALIVE_JITTER = 0.2  # доля случайного разброса паузы
+
+# Пауза после неудачного перелогина: растет вдвое до максимума
+RELOGIN_BACKOFF_BASE = 10
+RELOGIN_BACKOFF_MAX = 300
+
+
+def relogin_delay(failures):
+    delay = min(RELOGIN_BACKOFF_MAX, RELOGIN_BACKOFF_BASE * 2 ** max(0, failures - 1))
+    return delay * uniform(0.5, 1)
+
+
+async def keep_account(config, account):
+    """
+    Поддерживать сессию аккаунта. Ошибки запросов и загрузки сессии
+    обрабатываются в цикле, ошибки подготовки (IbApi, лимитер) — в supervise.
+    """
+    username = account['username']
+    ib = new_ib_instance(config, account)
+    limiter = new_rate_limiter(username, config)
 
+    async def call(method, *args):
+        """
+        Запрос в IBKR в потоке, после разрешения общего лимитера.
+        """
+        def paced():
+            # без токена запрос не уходит: ошибка попадет в общий обработчик
+            # цикла и переждет паузу перелогина
+            if limiter and not limiter.acquire(KEEPALIVE, RATE_LIMIT_TIMEOUT):
+                raise Exception(f"IBKR rate limit, {username} {method.__name__} skipped")
+            return method(*args)
+
+        return await asyncio.to_thread(paced)
+
+    async def pacing(response):
+        # Превышен лимит запросов — это не повод перелогиниваться
+        if limiter and is_pacing_error(response):
+            await asyncio.to_thread(limiter.report_rejection)
+            await asyncio.sleep(KEEPALIVE_SECONDS)
+            return True
+        return False
+
+    async def logout():
+        await call(ib.portal_logout)
+        await call(ib.sso_logout)
+
+    # Разнести аккаунты по времени
+    await asyncio.sleep(uniform(0, KEEPALIVE_SECONDS))
+
+    session_loaded = False
+    failures = 0
     while True:
-        # Проверить, есть жива ли SSO-сессия
-        sso = ib.sso_validate()
-
-        # Если сессия не работает — перелогин.
-        if sso.get("_ERROR") or not sso.get("USER_ID"):
-            cprint(" FULL RELOGIN ", "red", attrs=['reverse'])
-            ib.portal_logout()
-            ib.sso_logout()
-            if not ib.obtain_session():
-                print("Wait before reconnect")
-                sleep(10)
-            continue
-
-        # Тут должна быть живая сессия,
-        # проверить аунтетнификацию в iserver.
-        iserver = ib.iserver_auth_status()
-
-        # Не проверяется — перелогин.
-        if iserver.get("_ERROR") is not False:
-            print("bad iserver_status", iserver)
-            sleep(10)
-            continue
-
-        # Сессия есть, но iserver не authenticated.
-        # Попробовать оживить.
-        if not iserver.get("authenticated"):
-            print("iserver is not authenticated")
-            print("SOFT REAUTH")
-            iserver = ib.init_iserver_session()
-
-        # Если оживить не получилось — перелогин.
-        if not iserver.get("authenticated"):
-            ib.portal_logout()
-            ib.sso_logout()
-            continue
-
-        cprint(" GOOD SESSION ", "green", attrs=['reverse'])
-
-        sleep(1)
+        try:
+            # Битый файл сессии — такая же ошибка, как остальные: пауза и повтор
+            if not session_loaded:
+                await asyncio.to_thread(ib.load_session)
+                session_loaded = True
+
+            # Проверить, есть жива ли SSO-сессия
+            sso = await call(ib.sso_validate)
+            if await pacing(sso):
+                continue
+
+            # Если сессия не работает — перелогин.
+            if sso.get("_ERROR") or not sso.get("USER_ID"):
+                cprint(f" FULL RELOGIN {username} ", "red", attrs=['reverse'])
+                await logout()
+                if not await call(ib.obtain_session):
+                    failures += 1
+                    delay = relogin_delay(failures)
+                    print(f"{username}: wait {delay:.0f}s before reconnect")
+                    await asyncio.sleep(delay)
+                continue
+
+            # Тут должна быть живая сессия,
+            # проверить аунтетнификацию в iserver.
+            iserver = await call(ib.iserver_auth_status)
+            if await pacing(iserver):
+                continue
 
+            # Не проверяется — перелогин.
+            if iserver.get("_ERROR") is not False:
+                print(f"{username}: bad iserver_status", iserver)
+                failures += 1
+                await asyncio.sleep(relogin_delay(failures))
+                continue
+
+            # Сессия есть, но iserver не authenticated.
+            # Попробовать оживить.
+            if not iserver.get("authenticated"):
+                print(f"{username}: iserver is not authenticated")
+                print(f"{username}: SOFT REAUTH")
+                iserver = await call(ib.init_iserver_session)
+
+            # Если оживить не получилось — перелогин.
+            if not iserver.get("authenticated"):
+                await logout()
+                continue
+
+            failures = 0
+            cprint(f" GOOD SESSION {username} ", "green", attrs=['reverse'])
+
+            await asyncio.sleep(KEEPALIVE_SECONDS * uniform(1 - KEEPALIVE_JITTER, 1 + KEEPALIVE_JITTER))
+
+            try:
+                await call(ib.keep_session_alive)
+            except Exception as e:
+                cprint(f"{username}: Tickle exception {e}", "red")
+                await asyncio.sleep(3)
+
+        except Exception as e:
+            # Один аккаунт не должен ронять остальные
+            cprint(f"{username}: {get_traceback(e)}", "red")
+            failures += 1
+            await asyncio.sleep(relogin_delay(failures))
+
+
+async def supervise(config, account):
+    """
+    Перезапускать keep_account после любой ошибки, с паузой.
+    Один аккаунт не должен ронять остальные.
+    """
+    failures = 0
+    while True:
         try:
-            ib.keep_session_alive()
+            await keep_account(config, account)
         except Exception as e:
-            cprint(f"Tickle exception {e}", "red")
-            sleep(3)
+            failures += 1
+            cprint(f"{account['username']}: {get_traceback(e)}", "red")
+            await asyncio.sleep(relogin_delay(failures))
+
+
+@click.command()
+@coro
+@click.argument('config_path', type=click.Path(exists=True))
+async def main(config_path):
+    config = get_config(config_path)
+    accounts = get_accounts(config)
+
+    # По потоку на запрос каждого аккаунта, пока он ждет лимитер или IBKR
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=len(accounts) + 4)
+    )
+
+    startup_report("session_keeper")
+    cprint(f"аккаунтов: {len(accounts)}", "green")
+
+    results = await asyncio.gather(
+        *[supervise(config, account) for account in accounts],
+        return_exceptions=True,
+    )
+    for account, result in zip(accounts, results):
+        cprint(f"{account['username']}: остановлен {result!r}", "red")
 
 
 if __name__ == "__main__":
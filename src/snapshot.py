@@ -0,0 +1,286 @@
+"""
+Последняя цена и лучшие bid/ask по каждому conid.
+
+IBKR присылает в smd только изменившиеся поля, здесь они сливаются
+в полный снимок. Снимки пишутся в локальную shared memory таблицу сразу,
+а в Redis hash {symbol}:SNAPSHOT — не чаще раза в snapshot_flush_seconds,
+несколько обновлений одного conid между сбросами схлопываются в одну запись.
+
+Читать без подписки:
+    SnapshotReader("tradis_snapshot").get(265598)
+    await redis.hgetall("AAPL.NASDAQ:SNAPSHOT")
+"""
+import asyncio
+import math
+import struct
+from multiprocessing import resource_tracker, shared_memory
+
+from termcolor import cprint
+
+from config import redis_key
+
+# поле IBKR -> ключ в снимке
+FIELDS = {
+    "31": "last",
+    "7059": "last_size",
+    "84": "bid",
+    "88": "bid_size",
+    "86": "ask",
+    "85": "ask_size",
+}
+MARKET_DATA_FIELDS = list(FIELDS)
+VALUES = list(FIELDS.values())
+
+# version (нечетный, пока идет запись), conid, значения, updated_ms
+RECORD = struct.Struct("<qq" + "d" * len(VALUES) + "q")
+VERSION = struct.Struct("<q")
+
+SNAPSHOT_FLUSH_SECONDS = 0.25
+SNAPSHOT_CAPACITY = 1024
+
+# столько раз читатель перечитывает запись, пока писатель в середине записи;
+# нечетная версия дольше этого — писатель упал
+READ_RETRIES = 1000
+
+_store = None
+
+
+def parse_number(value):
+    """
+    IBKR шлет строки вида "C123.45", "H1.2", "1,200" или "1.5K".
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+
+    value = value.lstrip("CH").replace(",", "")
+    multiplier = 1
+    if value[-1:] in ("K", "M"):
+        multiplier = 1000 if value[-1] == "K" else 1000000
+        value = value[:-1]
+    try:
+        return float(value) * multiplier
+    except ValueError:
+        return None
+
+
+def get_snapshot_key(symbol):
+    return redis_key(f"{symbol}:SNAPSHOT")
+
+
+class SnapshotTable:
+    """
+    Таблица фиксированных записей в shared memory.
+    Писатель один (демон сделок), читателей сколько угодно.
+    Запись с conid 0 — пустая, версия 0 — в запись еще ни разу не писали.
+    """
+    def __init__(self, shm, capacity, owner):
+        self.shm = shm
+        self.capacity = capacity
+        self.owner = owner
+        self.slots = {}  # conid -> номер записи
+        self.free = []  # освобожденные записи
+        self._used = 0  # сколько записей выдавалось
+        self._versions = {}  # номер записи -> версия
+
+    @classmethod
+    def create(cls, name, capacity=SNAPSHOT_CAPACITY):
+        size = RECORD.size * capacity
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # осталась от упавшего процесса
+            old = shared_memory.SharedMemory(name=name)
+            old.close()
+            old.unlink()
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        shm.buf[:size] = bytes(size)
+        return cls(shm, capacity, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        shm = shared_memory.SharedMemory(name=name)
+        # иначе resource_tracker удалит чужую память при выходе читателя
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm, shm.size // RECORD.size, owner=False)
+
+    def _pack(self, slot, conid, values, updated):
+        version = self._versions.get(slot, 0) + 1
+        offset = slot * RECORD.size
+
+        # seqlock: нечетная версия, данные, четная версия
+        VERSION.pack_into(self.shm.buf, offset, version)
+        RECORD.pack_into(self.shm.buf, offset, version, conid, *values, updated)
+        VERSION.pack_into(self.shm.buf, offset, version + 1)
+        self._versions[slot] = version + 1
+
+    def write(self, conid, snapshot):
+        slot = self.slots.get(conid)
+        if slot is None:
+            if self.free:
+                slot = self.free.pop()
+            elif self._used < self.capacity:
+                slot = self._used
+                self._used += 1
+            else:
+                return
+            self.slots[conid] = slot
+
+        values = [snapshot.get(v) for v in VALUES]
+        values = [math.nan if v is None else v for v in values]
+        self._pack(slot, conid, values, snapshot.get("updated") or 0)
+
+    def clear(self, conid):
+        """
+        Обнулить запись инструмента и вернуть ее в свободные.
+        """
+        slot = self.slots.pop(conid, None)
+        if slot is None:
+            return
+        self._pack(slot, 0, [math.nan] * len(VALUES), 0)
+        self.free.append(slot)
+
+    def read_slot(self, slot):
+        """
+        Согласованная запись или None, если писатель так и не дописал ее.
+        """
+        offset = slot * RECORD.size
+        for _ in range(READ_RETRIES):
+            record = RECORD.unpack_from(self.shm.buf, offset)
+            if record[0] % 2:
+                # писатель посередине записи
+                continue
+            if VERSION.unpack_from(self.shm.buf, offset)[0] == record[0]:
+                return record
+        return None
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class SnapshotReader:
+    """
+    Чтение снимков из shared memory из любого процесса.
+    """
+    def __init__(self, name):
+        self.table = SnapshotTable.attach(name)
+        self._slots = {}
+
+    def _find(self, conid):
+        self._slots = {}
+        for slot in range(self.table.capacity):
+            record = self.table.read_slot(slot)
+            if record is None:
+                continue
+            if record[0] == 0:
+                # дальше записей не было
+                break
+            if record[1]:
+                self._slots[record[1]] = slot
+        return self._slots.get(conid)
+
+    def get(self, conid):
+        slot = self._slots.get(conid)
+        record = self.table.read_slot(slot) if slot is not None else None
+        if not record or record[1] != conid:
+            # запись освободили или отдали другому инструменту
+            slot = self._find(conid)
+            if slot is None:
+                return None
+            record = self.table.read_slot(slot)
+            if not record or record[1] != conid:
+                return None
+
+        snapshot = {"conid": record[1], "updated": record[-1]}
+        for name, value in zip(VALUES, record[2:-1]):
+            snapshot[name] = None if math.isnan(value) else value
+        return snapshot
+
+    def close(self):
+        self.table.close()
+
+
+class SnapshotStore:
+    def __init__(self, shm_name=None, capacity=SNAPSHOT_CAPACITY):
+        self.snapshots = {}  # conid -> снимок
+        self._dirty = set()
+        self.table = SnapshotTable.create(shm_name, capacity) if shm_name else None
+        self.flusher = None  # задача run_flusher
+
+    def merge(self, conid, symbol, json_data):
+        """
+        Влить частичное обновление smd в снимок.
+        Возвращает снимок или None, если полезных полей не было.
+        """
+        update = {}
+        for field, name in FIELDS.items():
+            value = parse_number(json_data.get(field))
+            if value is not None:
+                update[name] = value
+        if not update:
+            return None
+
+        snapshot = self.snapshots.setdefault(conid, {"conid": conid, "symbol": symbol})
+        snapshot.update(update)
+        snapshot["updated"] = json_data.get("_updated") or snapshot.get("updated")
+
+        if self.table:
+            self.table.write(conid, snapshot)
+        self._dirty.add(conid)
+        return snapshot
+
+    def remove(self, conid):
+        self.snapshots.pop(conid, None)
+        self._dirty.discard(conid)
+        if self.table:
+            self.table.clear(conid)
+
+    async def flush(self, redis_client):
+        if not self._dirty:
+            return 0
+
+        dirty, self._dirty = self._dirty, set()
+        pipe = redis_client.pipeline(transaction=False)
+        for conid in dirty:
+            snapshot = self.snapshots.get(conid)
+            if snapshot:
+                mapping = {k: v for k, v in snapshot.items() if v is not None}
+                pipe.hset(get_snapshot_key(snapshot["symbol"]), mapping=mapping)
+        await pipe.execute()
+        return len(dirty)
+
+    async def run_flusher(self, get_redis_func, interval=SNAPSHOT_FLUSH_SECONDS):
+        """
+        Бесконечный цикл сброса снимков в Redis, запускается отдельной задачей.
+        """
+        redis_client = get_redis_func()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush(redis_client)
+            except Exception as e:
+                cprint(f"snapshot flush error {e}", "red")
+                await asyncio.sleep(3)
+                redis_client = get_redis_func()
+
+    def start(self, get_redis_func, interval=SNAPSHOT_FLUSH_SECONDS):
+        """
+        Ссылка на задачу хранится здесь: asyncio держит задачи слабыми ссылками.
+        """
+        self.flusher = asyncio.create_task(self.run_flusher(get_redis_func, interval))
+        return self.flusher
+
+
+def get_snapshot_store(config):
+    global _store
+
+    if not _store:
+        _store = SnapshotStore(
+            shm_name=config.get('snapshot_shm_name'),
+            capacity=config.get('snapshot_capacity', SNAPSHOT_CAPACITY),
+        )
+
+    return _store
@@ -0,0 +1,228 @@
+"""
+Архив тиков на диске.
+
+На каждый инструмент и день (UTC) — append-only файл записей фиксированного
+размера {archive_dir}/{symbol}/{YYYYMMDD}.ticks и разреженный индекс
+{YYYYMMDD}.idx (время и номер каждой INDEX_EVERY-й записи).
+Файл читается через np.memmap как массив, без разбора.
+
+Писатель только копит тики в памяти, на диск они уходят пачкой
+из отдельного потока раз в tick_archive_flush_seconds,
+fsync — раз в tick_archive_fsync_seconds.
+
+    read_range("ticks", "AAPL.NASDAQ", start_ms, end_ms)["price"]
+"""
+import asyncio
+import os
+import struct
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from os.path import exists, join
+
+from termcolor import cprint
+
+# ts (ms UTC), price, size (NaN, если неизвестен)
+RECORD = struct.Struct("<qdd")
+INDEX_RECORD = struct.Struct("<qq")
+INDEX_EVERY = 1024
+
+FLUSH_SECONDS = 1
+FSYNC_SECONDS = 10
+
+_archive = None
+
+
+def get_dtype():
+    import numpy as np
+
+    return np.dtype([("ts", "<i8"), ("price", "<f8"), ("size", "<f8")])
+
+
+def get_day(ts_ms):
+    return datetime.utcfromtimestamp(ts_ms / 1000).strftime("%Y%m%d")
+
+
+def get_paths(archive_dir, symbol, day):
+    base = join(archive_dir, symbol, day)
+    return base + ".ticks", base + ".idx"
+
+
+def get_valid_index_size(index_path, count):
+    """
+    Размер индекса без недописанной записи и без ссылок дальше count тиков.
+    """
+    with open(index_path, "rb") as f:
+        data = f.read()
+    size = len(data) - len(data) % INDEX_RECORD.size
+    while size and INDEX_RECORD.unpack_from(data, size - INDEX_RECORD.size)[1] >= count:
+        size -= INDEX_RECORD.size
+    return size
+
+
+class TickArchiveWriter:
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        self._buffer = defaultdict(list)  # (symbol, day) -> [(ts, price, size)]
+        self._files = {}  # (symbol, day) -> (ticks file, index file, записей)
+        self._last_fsync = time.time()
+        self._lock = threading.Lock()  # write из потока и close при остановке
+        self.task = None  # задача run, asyncio держит задачи слабыми ссылками
+
+    def append(self, symbol, ts_ms, price, size=None):
+        if price is None:
+            return
+        self._buffer[(symbol, get_day(ts_ms))].append(
+            (int(ts_ms), price, float("nan") if size is None else size)
+        )
+
+    def _open(self, symbol, day):
+        files = self._files.get((symbol, day))
+        if files:
+            return files
+
+        # вчерашние файлы больше не понадобятся
+        for key in [k for k in self._files if k[0] == symbol]:
+            self._close(key)
+
+        os.makedirs(join(self.archive_dir, symbol), exist_ok=True)
+        ticks_path, index_path = get_paths(self.archive_dir, symbol, day)
+        ticks = open(ticks_path, "ab")
+        index = open(index_path, "ab")
+        count = ticks.tell() // RECORD.size
+        if ticks.tell() != count * RECORD.size:
+            # процесс упал посреди записи, иначе все следующие записи съедут
+            ticks.truncate(count * RECORD.size)
+        index.truncate(get_valid_index_size(index_path, count))
+        files = self._files[(symbol, day)] = [ticks, index, count]
+        return files
+
+    def _close(self, key):
+        ticks, index, _ = self._files.pop(key)
+        ticks.close()
+        index.close()
+
+    def write(self, batches, fsync=False):
+        """
+        Записать пачки на диск. Вызывается из потока, не из event loop.
+        """
+        with self._lock:
+            self._write(batches, fsync)
+
+    def _write(self, batches, fsync):
+        for (symbol, day), records in batches.items():
+            files = self._open(symbol, day)
+            ticks, index, count = files
+
+            data = bytearray(RECORD.size * len(records))
+            index_data = bytearray()
+            for n, record in enumerate(records):
+                RECORD.pack_into(data, n * RECORD.size, *record)
+                if (count + n) % INDEX_EVERY == 0:
+                    index_data += INDEX_RECORD.pack(record[0], count + n)
+
+            ticks.write(data)
+            if index_data:
+                index.write(index_data)
+            files[2] = count + len(records)
+
+        for ticks, index, _ in self._files.values():
+            ticks.flush()
+            index.flush()
+            if fsync:
+                os.fsync(ticks.fileno())
+                os.fsync(index.fileno())
+
+    async def flush(self, fsync=False):
+        if not self._buffer:
+            return
+        batches, self._buffer = self._buffer, defaultdict(list)
+        await asyncio.to_thread(self.write, batches, fsync)
+
+    async def run(self, flush_seconds=FLUSH_SECONDS, fsync_seconds=FSYNC_SECONDS):
+        while True:
+            await asyncio.sleep(flush_seconds)
+            fsync = time.time() - self._last_fsync >= fsync_seconds
+            try:
+                await self.flush(fsync)
+            except Exception as e:
+                cprint(f"tick archive error {e}", "red")
+            if fsync:
+                self._last_fsync = time.time()
+
+    def start(self, flush_seconds=FLUSH_SECONDS, fsync_seconds=FSYNC_SECONDS):
+        self.task = asyncio.create_task(self.run(flush_seconds, fsync_seconds))
+        return self.task
+
+    def close(self):
+        """
+        Дописать буфер с fsync и закрыть файлы. Синхронно, при остановке демона.
+        """
+        if self.task:
+            self.task.cancel()
+        batches, self._buffer = self._buffer, defaultdict(list)
+        with self._lock:
+            if batches:
+                self._write(batches, fsync=True)
+            for key in list(self._files):
+                self._close(key)
+
+
+def read_day(archive_dir, symbol, day, start_ms, end_ms):
+    import numpy as np
+
+    ticks_path, index_path = get_paths(archive_dir, symbol, day)
+    if not exists(ticks_path) or os.path.getsize(ticks_path) < RECORD.size:
+        return None
+
+    dtype = get_dtype()
+    count = os.path.getsize(ticks_path) // RECORD.size
+    ticks = np.memmap(ticks_path, dtype=dtype, mode="r", shape=(count,))
+
+    # по разреженному индексу сужаем окно, дальше бинарный поиск
+    lo, hi = 0, count
+    if exists(index_path):
+        index = np.fromfile(index_path, dtype=[("ts", "<i8"), ("n", "<i8")])
+        if len(index):
+            i = np.searchsorted(index["ts"], start_ms, side="left") - 1
+            j = np.searchsorted(index["ts"], end_ms, side="right")
+            lo = int(index["n"][i]) if i >= 0 else 0
+            hi = int(index["n"][j]) if j < len(index) else count
+
+    window = ticks[lo:hi]["ts"]
+    first = lo + int(np.searchsorted(window, start_ms, side="left"))
+    last = lo + int(np.searchsorted(window, end_ms, side="right"))
+    return ticks[first:last]
+
+
+def read_range(archive_dir, symbol, start_ms, end_ms):
+    """
+    Тики инструмента за [start_ms, end_ms] как структурированный массив
+    с полями ts, price, size. Для одного дня — срез memmap без копирования.
+    """
+    import numpy as np
+
+    parts = []
+    day = datetime.utcfromtimestamp(start_ms / 1000).date()
+    last_day = datetime.utcfromtimestamp(end_ms / 1000).date()
+    while day <= last_day:
+        part = read_day(archive_dir, symbol, day.strftime("%Y%m%d"), start_ms, end_ms)
+        if part is not None and len(part):
+            parts.append(part)
+        day += timedelta(days=1)
+
+    if not parts:
+        return np.empty(0, dtype=get_dtype())
+    if len(parts) == 1:
+        return parts[0]
+    return np.concatenate(parts)
+
+
+def get_tick_archive(config):
+    global _archive
+
+    if not _archive and config.get('tick_archive_dir'):
+        _archive = TickArchiveWriter(config['tick_archive_dir'])
+
+    return _archive